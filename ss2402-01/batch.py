@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from main import add_conversion_arguments, conversion_options, convert_study
+
+def unique_names(studies):
+    """出力名が重複する検査（フォルダaとa.zip、マニフェストの同名指定など）に_2, _3...を付けて一意にする
+
+    同時に変換すると出力を上書きし合うため、2つ目以降の名前を変えて警告を表示する（大文字・小文字は区別しない）。
+    """
+    used = set()
+    result = []
+    for path, name in studies:
+        unique = name
+        k = 2
+        while unique.lower() in used:
+            unique = f"{name}_{k}"
+            k += 1
+        if unique != name:
+            print(f"出力名{name}が重複するため、{path}は{unique}として出力します。", file=sys.stderr)
+        used.add(unique.lower())
+        result.append((path, unique))
+    return result
+
+def list_studies(target):
+    """フォルダ（直下の各フォルダ・ZIPを1検査とする）またはマニフェストから(入力, 出力名)の一覧を返す
+
+    マニフェストは1行に1検査で「入力パス」または「入力パス<TAB>出力名」を記述する（#以降はコメント）。
+    出力名が重複する場合はunique_namesで一意にする。
+    """
+    studies = []
+    if os.path.isdir(target):
+        for name in sorted(os.listdir(target)):
+            path = os.path.join(target, name)
+            if os.path.isdir(path) or name.lower().endswith(".zip"):
+                studies.append((path, os.path.splitext(name)[0] if os.path.isfile(path) else name))
+        return unique_names(studies)
+    base = os.path.dirname(os.path.abspath(target))
+    with open(target, encoding="utf-8") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split("\t")
+            path = parts[0].strip()
+            if not os.path.isabs(path):
+                path = os.path.join(base, path)
+            name = parts[1].strip() if len(parts) > 1 else os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+            studies.append((path, name))
+    return unique_names(studies)
+
+def input_bytes(in_path, entries):
+    """変換したDICOMデータの合計バイト数（ZIPは展開後のDICOMメンバーの合計）を返す"""
+    if os.path.isfile(in_path):
+        with zipfile.ZipFile(in_path, "r") as zip_ref:
+            return sum(
+                info.file_size for info in zip_ref.infolist() if info.filename.lower().endswith(".dcm")
+            )
+    return sum(os.path.getsize(e.path) for e in entries)
+
+def run_study(in_path, out_file, options):
+    """1検査を変換し、処理時間・スライス数・入力サイズなどの統計を返す（失敗しても例外は送出しない）"""
+    stats = {"input": in_path, "output": out_file, "slices": 0, "bytes": 0, "series": 0, "error": None}
+    start = time.perf_counter()
+    try:
+        results, entries = convert_study(in_path, out_file, jobs=1, **options)
+        stats["slices"] = len(entries)
+        stats["bytes"] = input_bytes(in_path, entries)
+        stats["series"] = len(results)
+        errors = [f"{name}: {e}" for _, name, e in results if e is not None]
+        if errors:
+            stats["error"] = "; ".join(errors)
+    except Exception as e:
+        stats["error"] = str(e)
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+def format_rate(slices, size, seconds):
+    """スライス/秒とMB/秒の表示文字列を返す"""
+    seconds = max(seconds, 1e-9)
+    return f"{slices / seconds:.1f} slices/s, {size / 1e6 / seconds:.1f} MB/s"
+
+def main():
+    parser = argparse.ArgumentParser(description="複数検査のDICOM→MHD/RAW変換をプロセスプールで一括実行")
+    parser.add_argument("target", type=str, help="検査フォルダ・ZIPを並べたフォルダ、またはマニフェストファイル")
+    parser.add_argument("out_dir", type=str, help="出力フォルダ")
+    add_conversion_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=None, help="同時に変換する検査数の上限（省略時はCPU数）")
+    parser.add_argument("--report", type=str, default=None, help="検査ごと・全体の統計をJSONで保存するファイル名")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.target):
+        print(f"入力{args.target}が存在しません。", file=sys.stderr)
+        sys.exit(1)
+    studies = list_studies(args.target)
+    if not studies:
+        print("変換する検査が見つかりません。", file=sys.stderr)
+        sys.exit(1)
+    os.makedirs(args.out_dir, exist_ok=True)
+    options = conversion_options(args)
+
+    all_stats = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {
+            executor.submit(run_study, path, os.path.join(args.out_dir, name), options): path
+            for path, name in studies
+        }
+        for future in as_completed(futures):
+            try:
+                stats = future.result()
+            except Exception as e:
+                stats = {"input": futures[future], "slices": 0, "bytes": 0, "series": 0, "seconds": 0.0, "error": str(e)}
+            all_stats.append(stats)
+            label = f"[{len(all_stats)}/{len(studies)}] {stats['input']}"
+            if stats["error"]:
+                print(f"{label}: 失敗 ({stats['error']})", file=sys.stderr)
+            else:
+                rate = format_rate(stats["slices"], stats["bytes"], stats["seconds"])
+                print(f"{label}: {stats['slices']}スライス, {stats['seconds']:.2f}秒 ({rate})")
+    elapsed = time.perf_counter() - start
+
+    succeeded = [s for s in all_stats if not s["error"]]
+    total_slices = sum(s["slices"] for s in succeeded)
+    total_bytes = sum(s["bytes"] for s in succeeded)
+    print(
+        f"合計: {len(succeeded)}/{len(studies)}検査成功, {total_slices}スライス, {elapsed:.2f}秒 "
+        f"({format_rate(total_slices, total_bytes, elapsed)})"
+    )
+    if args.report:
+        summary = {
+            "studies": len(studies),
+            "succeeded": len(succeeded),
+            "slices": total_slices,
+            "bytes": total_bytes,
+            "seconds": elapsed,
+            "slices_per_second": total_slices / max(elapsed, 1e-9),
+            "mb_per_second": total_bytes / 1e6 / max(elapsed, 1e-9),
+        }
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "studies": all_stats}, f, ensure_ascii=False, indent=2)
+    if len(succeeded) < len(studies):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
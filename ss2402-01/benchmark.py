@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from main import (
+    get_instance_number,
+    group_series,
+    iter_pixel_arrays,
+    rescale_params,
+    resolve_input,
+    volume_spacing,
+    window_range,
+    write_raw_mhd,
+)
+from synth import add_synth_arguments, generate, synth_options
+from windowing import ELEMENT_TYPES, convert_slice
+
+STAGES = ["scan", "decode", "window", "write"]
+
+def git_revision():
+    """現在のコミットのハッシュを返す（gitが使えない場合はNone）"""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_once(in_path, out_file, wl, ww, workers=None, element_type="uchar", compress=False, decode_backend="auto"):
+    """ヘッダー走査・デコード・ウィンドウ処理・書き込みを順に実行し、各段階の秒数を返す
+
+    各段階の結果は次の段階に渡すためメモリに保持する（最初のシリーズのみ計測）。
+    """
+    times = {}
+    start = time.perf_counter()
+    sorted_entries = get_instance_number(in_path, workers)
+    sorted_entries = group_series(sorted_entries)[0][1]
+    times["scan"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = [(e, p) for e, p in iter_pixel_arrays(sorted_entries, workers, decode_backend) if not isinstance(p, Exception)]
+    times["decode"] = time.perf_counter() - start
+    if not decoded:
+        raise RuntimeError("デコードできたスライスがありません。")
+
+    start = time.perf_counter()
+    min_val, max_val = window_range(decoded[0][0].modality, wl, ww)
+    if element_type == "uchar" and min_val is None:
+        min_val = np.float32(min(p.min() for _, p in decoded))
+        max_val = np.float32(max(p.max() for _, p in decoded))
+    volume = np.stack(
+        [convert_slice(p, *rescale_params(e), element_type, min_val, max_val) for e, p in decoded], axis=0
+    )
+    times["window"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    metadata = {
+        "DimSize": list(volume.shape[::-1]),
+        "ElementSpacing": volume_spacing(sorted_entries),
+        "ElementType": ELEMENT_TYPES[element_type][0],
+    }
+    write_raw_mhd(volume, metadata, out_file, compress, workers)
+    times["write"] = time.perf_counter() - start
+    times["total"] = sum(times[stage] for stage in STAGES)
+    return times, len(decoded), int(sum(p.nbytes for _, p in decoded))
+
+def summarize(runs):
+    """各段階の最小値・中央値を返す"""
+    return {
+        stage: {"min": min(r[stage] for r in runs), "median": float(np.median([r[stage] for r in runs]))}
+        for stage in STAGES + ["total"]
+    }
+
+def load_results(results_file):
+    """これまでの計測結果（1行1件のJSON）を読み込む"""
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def previous_result(history, record):
+    """同じラベル・条件で計測した直前の結果を返す"""
+    for old in reversed(history):
+        if old.get("label") == record["label"] and old.get("params") == record["params"]:
+            return old
+    return None
+
+def print_summary(record, previous=None):
+    """段階ごとの中央値と、前回からの変化率を表示する"""
+    for stage in STAGES + ["total"]:
+        median = record["stages"][stage]["median"]
+        line = f"{stage:>7}: {median * 1000:9.1f} ms"
+        if previous is not None:
+            before = previous["stages"][stage]["median"]
+            line += f"  (前回 {before * 1000:9.1f} ms, {(median - before) / max(before, 1e-9) * 100:+.1f}%)"
+        print(line)
+    seconds = record["stages"]["total"]["median"]
+    print(f"{record['slices']}スライス, {record['slices'] / max(seconds, 1e-9):.1f} slices/s, "
+          f"{record['pixel_bytes'] / 1e6 / max(seconds, 1e-9):.1f} MB/s（デコード後の画素データ基準）")
+
+def main():
+    parser = argparse.ArgumentParser(description="DICOM→MHD/RAW変換の段階別ベンチマーク（ヘッダー走査・デコード・ウィンドウ処理・書き込み）")
+    parser.add_argument("in_path", type=str, nargs="?", default=None, help="入力フォルダまたはZIP（省略時は合成データを作成）")
+    add_synth_arguments(parser)
+    parser.add_argument("--wl", type=float, default=40.0, help="ウィンドウレベル（CT画像のみ）")
+    parser.add_argument("--ww", type=float, default=400.0, help="ウィンドウ幅（CT画像のみ）")
+    parser.add_argument("--element-type", choices=sorted(ELEMENT_TYPES), default="uchar", help="出力データ型")
+    parser.add_argument("--compress", action="store_true", help="CompressedData形式（.zraw）で書き込む")
+    parser.add_argument("--workers", type=int, default=None, help="ヘッダー読み込み・デコードの並列数")
+    parser.add_argument("--decode-backend", choices=["auto", "thread", "process"], default="auto", help="デコード方式")
+    parser.add_argument("--repeat", type=int, default=3, help="計測の繰り返し回数（中央値・最小値を記録）")
+    parser.add_argument("--label", type=str, default="default", help="比較に使う計測条件の名前")
+    parser.add_argument("--results", type=str, default="benchmark_results.jsonl", help="計測結果を追記するファイル")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="dicom_bench_")
+    try:
+        if args.in_path is None:
+            params = synth_options(args)
+            in_path = os.path.join(work_dir, "synth.zip" if args.zip else "synth")
+            print(f"合成データを作成中: {params}")
+            generate(in_path, **params)
+        else:
+            params = {"input": os.path.abspath(args.in_path)}
+            in_path, _ = resolve_input(args.in_path)
+        params.update(
+            {
+                "wl": args.wl,
+                "ww": args.ww,
+                "element_type": args.element_type,
+                "compress": args.compress,
+                "workers": args.workers,
+                "decode_backend": args.decode_backend,
+            }
+        )
+        runs = []
+        for i in range(args.repeat):
+            times, slices, pixel_bytes = run_once(
+                in_path,
+                os.path.join(work_dir, f"out{i}"),
+                args.wl,
+                args.ww,
+                args.workers,
+                args.element_type,
+                args.compress,
+                args.decode_backend,
+            )
+            runs.append(times)
+    except Exception as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "label": args.label,
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "params": params,
+        "slices": slices,
+        "pixel_bytes": pixel_bytes,
+        "stages": summarize(runs),
+        "runs": runs,
+    }
+    previous = previous_result(load_results(args.results), record)
+    print_summary(record, previous)
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    print(f"計測結果を{args.results}に追記しました。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import json
+import sqlite3
+
+class HeaderIndex:
+    """DICOMヘッダーの解析結果をSQLiteに保存し、再実行時の解析を省略するクラス
+
+    各ファイルは名前・サイズ・スタンプ（ファイルは更新時刻、ZIPメンバーはCRC）で識別し、
+    いずれかが変わった場合や保存されている項目が異なる場合は自動的に再解析の対象とする。
+    """
+
+    def __init__(self, index_file, fields):
+        self.index_file = index_file
+        self.fields = list(fields)
+        self._conn = sqlite3.connect(index_file)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS headers ("
+            "name TEXT PRIMARY KEY, size INTEGER NOT NULL, stamp INTEGER NOT NULL, header TEXT)"
+        )
+        self._rows = {
+            name: (size, stamp, header)
+            for name, size, stamp, header in self._conn.execute("SELECT name, size, stamp, header FROM headers")
+        }
+
+    def lookup(self, name, size, stamp):
+        """保存済みの解析結果を(見つかったか, 項目の辞書またはNone)で返す
+
+        InstanceNumberを持たないファイルは項目の辞書がNoneとして保存されている。
+        """
+        row = self._rows.get(name)
+        if row is None or row[0] != size or row[1] != stamp:
+            return False, None
+        header = json.loads(row[2]) if row[2] is not None else None
+        if header is None:
+            return True, None
+        if sorted(header) != sorted(self.fields):
+            return False, None
+        return True, {k: tuple(v) if isinstance(v, list) else v for k, v in header.items()}
+
+    def store(self, name, size, stamp, header):
+        """解析結果を保存する（headerがNoneの場合はDICOMとして使わないファイルとして記録）"""
+        data = json.dumps(header) if header is not None else None
+        self._rows[name] = (size, stamp, data)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO headers (name, size, stamp, header) VALUES (?, ?, ?, ?)",
+            (name, size, stamp, data),
+        )
+
+    def prune(self, names):
+        """現在存在しないファイルの記録を削除する"""
+        stale = [(name,) for name in set(self._rows) - set(names)]
+        self._conn.executemany("DELETE FROM headers WHERE name = ?", stale)
+        for (name,) in stale:
+            del self._rows[name]
+
+    def close(self):
+        """変更を確定してデータベースを閉じる"""
+        self._conn.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,12 +1,23 @@
 import argparse
+import multiprocessing
 import os
 import shutil
 import sys
 import tempfile
+import threading
 import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import pydicom
+from pydicom.uid import UID
+
+from header_index import HeaderIndex
+from mhd_io import RawVolumeWriter, open_volume_writer, write_mhd_header
+from mip import MipAccumulator
+from resample import resample_mhd
+from windowing import ELEMENT_TYPES, convert_slice, parse_window_presets, window_slice_presets
 
 def extract_zip(zip_file):
     """ZIPファイルを解凍し、一時ディレクトリのパスを返す"""
@@ -17,106 +28,661 @@ def extract_zip(zip_file):
         zip_ref.extractall(temp_dir)
     return temp_dir
 
-def get_instance_number(in_folder):
-    """フォルダ内のDICOMファイルをInstance Number順に並べて返す"""
-    dicom_files = []
-    for root, _, files in os.walk(in_folder):
-        for f in files:
-            if f.lower().endswith(".dcm"):
-                dicom_files.append(os.path.join(root, f))
-    if not dicom_files:
+DicomEntry = namedtuple(
+    "DicomEntry",
+    [
+        "path",
+        "member",
+        "instance_number",
+        "slice_location",
+        "pixel_spacing",
+        "modality",
+        "rescale_slope",
+        "rescale_intercept",
+        "series_uid",
+        "series_number",
+        "image_position",
+        "image_orientation",
+        "transfer_syntax",
+    ],
+)
+
+# ヘッダー走査で読み込むタグ（画素データは読まない）
+HEADER_TAGS = [
+    "InstanceNumber",
+    "SliceLocation",
+    "PixelSpacing",
+    "Modality",
+    "RescaleSlope",
+    "RescaleIntercept",
+    "SeriesInstanceUID",
+    "SeriesNumber",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+]
+
+# ZIPファイルのハンドルはスレッドごとに保持する（メンバーを並列に読むため）
+_zip_handles = threading.local()
+
+def _open_zip(zip_file):
+    """現在のスレッド用に開いたZipFileを返す"""
+    handles = getattr(_zip_handles, "handles", None)
+    if handles is None:
+        handles = _zip_handles.handles = {}
+    if zip_file not in handles:
+        handles[zip_file] = zipfile.ZipFile(zip_file, "r")
+    return handles[zip_file]
+
+def _reset_zip_handles():
+    """親プロセスから引き継いだZipFileを破棄する（プロセスプールのinitializer）
+
+    fork時に引き継いだハンドルはファイル位置を親・他のワーカーと共有するため、各ワーカーで開き直す。
+    """
+    _zip_handles.handles = {}
+
+def read_dicom(path, member=None, **kwargs):
+    """DICOMファイルまたはZIP内のメンバーを展開せずに読み込む"""
+    if member is None:
+        return pydicom.dcmread(path, **kwargs)
+    with _open_zip(path).open(member) as f:
+        return pydicom.dcmread(f, **kwargs)
+
+def _optional_int(value):
+    """空の場合はNone、それ以外はintに変換"""
+    return int(value) if value not in (None, "") else None
+
+def _optional_floats(value):
+    """空の場合はNone、それ以外はfloatのタプルに変換"""
+    return tuple(map(float, value)) if value not in (None, "") else None
+
+def read_header(path, member=None):
+    """画素データの手前までDICOMヘッダーを読み込み、DicomEntryを返す"""
+    ds = read_dicom(path, member, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    instance_number = getattr(ds, "InstanceNumber", None)
+    if instance_number is None:
+        return None
+    slice_location = getattr(ds, "SliceLocation", None)
+    spacing = getattr(ds, "PixelSpacing", None) or [1.0, 1.0]
+    return DicomEntry(
+        path=path,
+        member=member,
+        instance_number=int(instance_number),
+        slice_location=float(slice_location) if slice_location is not None else None,
+        pixel_spacing=tuple(map(float, spacing)),
+        modality=getattr(ds, "Modality", None),
+        rescale_slope=float(getattr(ds, "RescaleSlope", 1.0)),
+        rescale_intercept=float(getattr(ds, "RescaleIntercept", 0.0)),
+        series_uid=str(getattr(ds, "SeriesInstanceUID", "")),
+        series_number=_optional_int(getattr(ds, "SeriesNumber", None)),
+        image_position=_optional_floats(getattr(ds, "ImagePositionPatient", None)),
+        image_orientation=_optional_floats(getattr(ds, "ImageOrientationPatient", None)),
+        transfer_syntax=str(getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", "")),
+    )
+
+def source_name(path, member=None):
+    """エラー表示用にファイル名（ZIPの場合はメンバー名付き）を返す"""
+    return f"{path}:{member}" if member is not None else path
+
+def _read_header_safe(source):
+    """ヘッダーを読み込み、(読み込めたか, DicomEntryまたはNone)を返す"""
+    try:
+        return True, read_header(*source)
+    except Exception as e:
+        print(f"ファイル{source_name(*source)}の読み込み失敗: {e}", file=sys.stderr)
+        return False, None
+
+def list_dicom_sources(in_path):
+    """フォルダ内のDICOMファイル、またはZIP内のDICOMメンバーを(パス, メンバー名)の一覧で返す"""
+    sources = []
+    if os.path.isfile(in_path):
+        if not zipfile.is_zipfile(in_path):
+            raise ValueError(f"{in_path}は有効なZIPファイルではありません。")
+        with zipfile.ZipFile(in_path, "r") as zip_ref:
+            for info in zip_ref.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(".dcm"):
+                    sources.append((in_path, info.filename))
+    else:
+        for root, _, files in os.walk(in_path):
+            for f in files:
+                if f.lower().endswith(".dcm"):
+                    sources.append((os.path.join(root, f), None))
+    return sources
+
+def default_index_file(in_path):
+    """入力フォルダ・ZIPの隣に置くヘッダーインデックスのファイル名を返す"""
+    return os.path.normpath(in_path) + ".dcmindex.sqlite"
+
+def source_signature(in_path, path, member=None, info=None):
+    """ヘッダーインデックスで使う(名前, サイズ, スタンプ)を返す（ZIPメンバーはCRC、ファイルは更新時刻）
+
+    ZIPメンバーの場合はinfoにZipInfo（ZipFile.getinfoの結果）を渡す。
+    """
+    if member is not None:
+        return member, info.file_size, info.CRC
+    stat = os.stat(path)
+    return os.path.relpath(path, in_path), stat.st_size, stat.st_mtime_ns
+
+def source_signatures(in_path, sources):
+    """全ファイルの(名前, サイズ, スタンプ)を返す（ZIPは1回だけ開いてメンバー情報を読む）"""
+    if not os.path.isfile(in_path):
+        return [source_signature(in_path, *source) for source in sources]
+    with zipfile.ZipFile(in_path, "r") as zip_ref:
+        return [source_signature(in_path, path, member, zip_ref.getinfo(member)) for path, member in sources]
+
+def get_instance_number(in_folder, workers=None, index_file=None):
+    """フォルダまたはZIP内のDICOMヘッダーを並列に読み込み、Instance Number順のDicomEntryを返す
+
+    index_fileを指定すると解析結果を保存し、変更のないファイルは次回以降の解析を省略する。
+    """
+    sources = list_dicom_sources(in_folder)
+    if not sources:
         raise FileNotFoundError("指定フォルダにDICOMファイルが見つかりません。")
-    instances = []
-    for f in dicom_files:
-        try:
-            dcm_data = pydicom.dcmread(f)
-            instance_number = int(getattr(dcm_data, "InstanceNumber", -1))
-            if instance_number == -1:
-                continue
-            instances.append((f, instance_number))
-        except Exception as e:
-            print(f"ファイル{f}の読み込み失敗: {e}", file=sys.stderr)
-    if not instances:
+    entries = []
+    if index_file is None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            entries = [e for _, e in executor.map(_read_header_safe, sources) if e is not None]
+    else:
+        with HeaderIndex(index_file, DicomEntry._fields[2:]) as index:
+            signatures = source_signatures(in_folder, sources)
+            pending = []
+            for source, signature in zip(sources, signatures):
+                hit, header = index.lookup(*signature)
+                if not hit:
+                    pending.append((source, signature))
+                elif header is not None:
+                    entries.append(DicomEntry(*source, **header))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(_read_header_safe, [source for source, _ in pending])
+                for (source, signature), (ok, entry) in zip(pending, results):
+                    if not ok:
+                        continue
+                    if entry is None:
+                        index.store(*signature, None)
+                        continue
+                    header = entry._asdict()
+                    del header["path"], header["member"]
+                    index.store(*signature, header)
+                    entries.append(entry)
+            index.prune([signature[0] for signature in signatures])
+        print(
+            f"ヘッダーインデックス: {len(sources) - len(pending)}件を再利用、{len(pending)}件を解析しました。"
+        )
+    if not entries:
         raise ValueError("有効なDICOMファイルが見つかりません。")
-    instances.sort(key=lambda x: x[1])
-    return [x[0] for x in instances]
+    entries.sort(key=lambda e: e.instance_number)
+    return entries
+
+def group_series(sorted_entries):
+    """DicomEntryをSeriesInstanceUIDごとにまとめ、(UID, Instance Number順のDicomEntry)の一覧を返す"""
+    groups = {}
+    for entry in sorted_entries:
+        groups.setdefault(entry.series_uid, []).append(entry)
+    return sorted(
+        groups.items(),
+        key=lambda item: (item[1][0].series_number is None, item[1][0].series_number or 0, item[0]),
+    )
+
+def series_out_files(series, out_file):
+    """シリーズごとの出力ファイル名を返す（シリーズ番号が一意ならそれを、なければ通し番号を付ける）"""
+    if len(series) == 1:
+        return [out_file]
+    numbers = [entries[0].series_number for _, entries in series]
+    if None not in numbers and len(set(numbers)) == len(numbers):
+        return [f"{out_file}_series{number}" for number in numbers]
+    return [f"{out_file}_{k + 1}" for k in range(len(series))]
+
+def _decode_pixels(entry):
+    """1スライス分の画素データを読み込んでデコードする"""
+    return read_dicom(entry.path, entry.member).pixel_array
+
+def is_compressed(entry):
+    """JPEG Lossless・JPEG-LS・JPEG 2000などの圧縮転送構文か判定"""
+    return bool(entry.transfer_syntax) and UID(entry.transfer_syntax).is_compressed
 
-def resolution_z(dicom1, dicom2):
-    """2枚のDICOM画像からZ方向解像度を算出"""
+def choose_decode_backend(sorted_entries, backend="auto"):
+    """デコードに使う並列化方式（"thread"または"process"）を決める
+
+    autoの場合、圧縮転送構文を含むシリーズはGILの影響を受けないプロセスプールでデコードする。
+    プロセスプールのワーカー内（batch.py・複数シリーズの並列変換・watch.py）では、
+    プロセス数が同時変換数×CPU数に増えないよう、指定によらずスレッドを使う。
+    """
+    if multiprocessing.parent_process() is not None:
+        return "thread"
+    if backend != "auto":
+        return backend
+    if (os.cpu_count() or 1) == 1:
+        return "thread"
+    return "process" if any(is_compressed(e) for e in sorted_entries) else "thread"
+
+def iter_pixel_arrays(sorted_entries, workers=None, backend="auto", window=None):
+    """画素データを並列にデコードし、入力順に(DicomEntry, 画素配列または例外)を返す
+
+    先読みするスライス数をwindow（省略時は並列数の2倍）までに制限し、
+    デコードが終わったスライスも入力順が来るまで保持するのはこの範囲だけに抑える。
+    """
+    backend = choose_decode_backend(sorted_entries, backend)
+    if backend == "process":
+        workers = workers or os.cpu_count() or 1
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_reset_zip_handles)
+    else:
+        workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        executor = ThreadPoolExecutor(max_workers=workers)
+    window = max(window or 2 * workers, 1)
+    with executor:
+        pending = deque()
+        for entry in sorted_entries:
+            pending.append((entry, executor.submit(_decode_pixels, entry)))
+            if len(pending) >= window:
+                yield _pop_result(pending)
+        while pending:
+            yield _pop_result(pending)
+
+def _pop_result(pending):
+    """先頭のデコード結果を取り出す"""
+    entry, future = pending.popleft()
     try:
-        slice_location1 = float(getattr(dicom1, "SliceLocation", 0.0))
-        slice_location2 = float(getattr(dicom2, "SliceLocation", 0.0))
-        spacing = abs(slice_location2 - slice_location1)
-        return spacing if spacing > 0 else 1.0
-    except Exception:
-        print("SliceLocation取得失敗。デフォルト値1.0を使用。", file=sys.stderr)
+        return entry, future.result()
+    except Exception as e:
+        return entry, e
+
+def slice_positions(sorted_entries):
+    """各スライスのスライス法線方向の位置[mm]を返す
+
+    ImagePositionPatientとImageOrientationPatientから求め、無い場合はSliceLocationを使う。
+    どちらも揃わない場合はNoneを返す。
+    """
+    orientation = sorted_entries[0].image_orientation
+    if orientation is not None and all(e.image_position is not None for e in sorted_entries):
+        normal = np.cross(orientation[:3], orientation[3:])
+        positions = np.array([e.image_position for e in sorted_entries], dtype=np.float64)
+        deltas = np.diff(positions, axis=0)
+        along = deltas @ normal
+        if len(deltas) and np.abs(deltas - np.outer(along, normal)).max() > 1e-3:
+            print("スライス位置がスライス法線方向からずれています（ガントリ傾斜）。Z方向はスライス法線方向の間隔で扱います。", file=sys.stderr)
+        return positions @ normal
+    if all(e.slice_location is not None for e in sorted_entries):
+        return np.array([e.slice_location for e in sorted_entries], dtype=np.float64)
+    return None
+
+def resolution_z(sorted_entries):
+    """全スライスの位置からZ方向解像度を算出（間隔が一定でない場合は警告する）"""
+    if len(sorted_entries) < 2:
         return 1.0
+    positions = slice_positions(sorted_entries)
+    if positions is None:
+        print("スライス位置取得失敗。デフォルト値1.0を使用。", file=sys.stderr)
+        return 1.0
+    gaps = np.abs(np.diff(positions))
+    spacing = float(np.median(gaps))
+    if spacing <= 0:
+        return 1.0
+    if gaps.max() - gaps.min() > max(1e-3, 0.01 * spacing):
+        print(
+            f"スライス間隔が一定ではありません（{gaps.min():.3f}〜{gaps.max():.3f}mm）。中央値{spacing:.3f}mmを使用。",
+            file=sys.stderr,
+        )
+    return spacing
 
-def convert_hu(dcm, pixel_array):
-    """CT画像の場合、画素値をHU値に変換"""
-    rescale_slope = float(getattr(dcm, "RescaleSlope", 1.0))
-    rescale_intercept = float(getattr(dcm, "RescaleIntercept", 0.0))
-    hu = rescale_slope * pixel_array + rescale_intercept
-    return hu
+def rescale_params(entry):
+    """CT画像の場合はHU値変換の傾き・切片、それ以外は恒等変換を返す"""
+    if entry.modality == "CT":
+        return entry.rescale_slope, entry.rescale_intercept
+    return 1.0, 0.0
 
-def create_volume(sorted_files, wl, ww):
-    """DICOMファイル群から3次元ボリュームデータを生成"""
-    slices = []
-    spacing_z = None
-    modality = None
-    spacing_x = spacing_y = None
-    for idx, f in enumerate(sorted_files):
-        try:
-            ds = pydicom.dcmread(f)
-            modality = getattr(ds, "Modality", None)
-            img = ds.pixel_array.astype(np.float32)
-            if modality == "CT":
-                img = convert_hu(ds, img)
-            slices.append(img)
-            if idx == 0:
-                spacing = getattr(ds, "PixelSpacing", [1.0, 1.0])
-                spacing_x, spacing_y = map(float, spacing)
-            if idx == 1 and spacing_z is None:
-                dicom1 = pydicom.dcmread(sorted_files[0])
-                dicom2 = pydicom.dcmread(sorted_files[1])
-                spacing_z = resolution_z(dicom1, dicom2)
-        except Exception as e:
-            print(f"ファイル{f}処理中エラー: {e}", file=sys.stderr)
-    if not slices:
+def volume_spacing(sorted_entries):
+    """X, Y, Z方向の解像度を返す"""
+    spacing_x, spacing_y = sorted_entries[0].pixel_spacing
+    return [spacing_x, spacing_y, resolution_z(sorted_entries)]
+
+def window_range(modality, wl, ww):
+    """CT画像のウィンドウ範囲を返す（CT以外は全体の最小値・最大値を使うためNone）"""
+    if modality == "CT":
+        return wl - (ww / 2), wl + (ww / 2)
+    return None, None
+
+def create_volume(
+    sorted_entries, wl, ww, workers=None, element_type="uchar", mip=None, decode_backend="auto", reorder_window=None
+):
+    """DICOMファイル群から3次元ボリュームデータを生成（画素データは各ファイル1回のみ読み込む）
+
+    mip（MipAccumulator）を指定すると、変換したスライスごとにMIPを更新する。
+    decode_backend・reorder_windowはiter_pixel_arraysの並列化方式と先読み枚数。
+    """
+    decoded = []
+    for entry, pixels in iter_pixel_arrays(sorted_entries, workers, decode_backend, reorder_window):
+        if isinstance(pixels, Exception):
+            print(f"ファイル{source_name(entry.path, entry.member)}処理中エラー: {pixels}", file=sys.stderr)
+            continue
+        decoded.append((entry, pixels))
+    if not decoded:
         raise RuntimeError("ボリュームデータの作成に失敗しました。")
+    min_val, max_val = window_range(decoded[0][0].modality, wl, ww)
+    if element_type == "uchar" and min_val is None:
+        min_val = np.float32(min(pixels.min() for _, pixels in decoded))
+        max_val = np.float32(max(pixels.max() for _, pixels in decoded))
+    slices = []
+    for z, (entry, pixels) in enumerate(decoded):
+        img = convert_slice(pixels, *rescale_params(entry), element_type, min_val, max_val)
+        if mip is not None:
+            mip.add(z, img)
+        slices.append(img)
     volume = np.stack(slices, axis=0)
-    if spacing_z is None:
-        spacing_z = 1.0
-    if modality == "CT":
-        min_val = wl - (ww / 2)
-        max_val = wl + (ww / 2)
-    else:
-        min_val = volume.min()
-        max_val = volume.max()
-    volume_normalized = (volume - min_val) / (max_val - min_val + 1e-8)
-    volume_normalized = np.clip(volume_normalized, 0, 1)
-    volume_scaled = (volume_normalized * 255).astype(np.uint8)
     metadata = {
-        "DimSize": list(volume_scaled.shape),
-        "ElementSpacing": [spacing_x, spacing_y, spacing_z],
-        "ElementType": "MET_UCHAR",
+        "DimSize": list(volume.shape[::-1]),
+        "ElementSpacing": volume_spacing(sorted_entries),
+        "ElementType": ELEMENT_TYPES[element_type][0],
+    }
+    return volume, metadata
+
+def create_volume_streaming(
+    sorted_entries,
+    wl,
+    ww,
+    out_file,
+    workers=None,
+    element_type="uchar",
+    compress=False,
+    mip=None,
+    decode_backend="auto",
+    reorder_window=None,
+):
+    """スライスごとに変換し、出力.rawのメモリマップ（compress指定時は並列圧縮した.zraw）へ直接書き込む
+
+    CT以外を256階調で出力する場合は全体の最小値・最大値が必要なため、
+    一度元の画素型のまま一時ファイルに書き出してから変換する。
+    mip（MipAccumulator）を指定すると、書き込むスライスごとにMIPを更新する。
+    """
+    tmp_filename = out_file + ".tmp.raw"
+    out_dtype = ELEMENT_TYPES[element_type][1]
+    writer = None
+    deferred = False
+    count = 0
+    min_val = max_val = None
+    vol_min = vol_max = None
+    try:
+        for entry, pixels in iter_pixel_arrays(sorted_entries, workers, decode_backend, reorder_window):
+            if isinstance(pixels, Exception):
+                print(f"ファイル{source_name(entry.path, entry.member)}処理中エラー: {pixels}", file=sys.stderr)
+                continue
+            if writer is None:
+                min_val, max_val = window_range(entry.modality, wl, ww)
+                deferred = element_type == "uchar" and min_val is None
+                shape = (len(sorted_entries),) + pixels.shape
+                if deferred:
+                    writer = RawVolumeWriter(tmp_filename, shape, pixels.dtype)
+                else:
+                    writer = open_volume_writer(out_file, shape, out_dtype, compress, workers)
+            if deferred:
+                writer.write_slice(count, pixels)
+                vol_min = pixels.min() if vol_min is None else min(vol_min, pixels.min())
+                vol_max = pixels.max() if vol_max is None else max(vol_max, pixels.max())
+            else:
+                img = convert_slice(pixels, *rescale_params(entry), element_type, min_val, max_val)
+                if mip is not None:
+                    mip.add(count, img)
+                writer.write_slice(count, img)
+            count += 1
+        if writer is None:
+            raise RuntimeError("ボリュームデータの作成に失敗しました。")
+        writer.close(count)
+        shape = writer.shape
+        out = writer
+        if deferred:
+            min_val, max_val = np.float32(vol_min), np.float32(vol_max)
+            tmp_volume = np.memmap(tmp_filename, dtype=writer.dtype, mode="r", shape=shape)
+            with open_volume_writer(out_file, shape, out_dtype, compress, workers) as out:
+                for z in range(shape[0]):
+                    img = convert_slice(tmp_volume[z], 1.0, 0.0, element_type, min_val, max_val)
+                    if mip is not None:
+                        mip.add(z, img)
+                    out.write_slice(z, img)
+            del tmp_volume
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    metadata = {
+        "DimSize": list(shape[::-1]),
+        "ElementSpacing": volume_spacing(sorted_entries),
+        "ElementType": ELEMENT_TYPES[element_type][0],
+    }
+    mhd_filename = write_mhd_header(metadata, out_file, out.data_filename, out.compressed_size)
+    print(f"RawデータとMHDヘッダーを {out.data_filename} と {mhd_filename} に保存しました。")
+    return metadata
+
+def preset_out_files(out_file, presets):
+    """ウィンドウプリセットごとの出力ファイル名（<出力名>_<プリセット名>）を返す"""
+    return [f"{out_file}_{name}" for name, _, _ in presets]
+
+def create_preset_volumes(
+    sorted_entries,
+    presets,
+    out_file,
+    workers=None,
+    compress=False,
+    mips=None,
+    decode_backend="auto",
+    reorder_window=None,
+):
+    """各スライスを1回だけデコードし、複数のウィンドウプリセットの256階調ボリュームへ振り分けて保存
+
+    presetsは(名前, WL, WW)の一覧で、<出力名>_<名前>のMHD/RAWを1つずつ書き込む。
+    mipsを指定すると、プリセットごとのMipAccumulatorを同時に更新する。(出力ファイル名, metadata)の一覧を返す。
+    """
+    names = preset_out_files(out_file, presets)
+    ranges = [window_range("CT", wl, ww) for _, wl, ww in presets]
+    writers = []
+    count = 0
+    try:
+        for entry, pixels in iter_pixel_arrays(sorted_entries, workers, decode_backend, reorder_window):
+            if isinstance(pixels, Exception):
+                print(f"ファイル{source_name(entry.path, entry.member)}処理中エラー: {pixels}", file=sys.stderr)
+                continue
+            if not writers:
+                shape = (len(sorted_entries),) + pixels.shape
+                for name in names:
+                    writers.append(open_volume_writer(name, shape, np.uint8, compress, workers))
+            images = window_slice_presets(pixels, *rescale_params(entry), ranges)
+            for i, (writer, img) in enumerate(zip(writers, images)):
+                if mips is not None:
+                    mips[i].add(count, img)
+                writer.write_slice(count, img)
+            count += 1
+        if not writers:
+            raise RuntimeError("ボリュームデータの作成に失敗しました。")
+        for writer in writers:
+            writer.close(count)
+    finally:
+        for writer in writers:
+            writer.close()
+    spacing = volume_spacing(sorted_entries)
+    outputs = []
+    for name, writer in zip(names, writers):
+        metadata = {
+            "DimSize": list(writer.shape[::-1]),
+            "ElementSpacing": spacing,
+            "ElementType": ELEMENT_TYPES["uchar"][0],
+        }
+        mhd_filename = write_mhd_header(metadata, name, writer.data_filename, writer.compressed_size)
+        print(f"RawデータとMHDヘッダーを {writer.data_filename} と {mhd_filename} に保存しました。")
+        outputs.append((name, metadata))
+    return outputs
+
+def write_raw_mhd(volume, metadata, out_file, compress=False, workers=None):
+    """ボリュームデータをMHD/RAW形式で保存（compress指定時は並列圧縮した.zrawで保存）"""
+    if compress:
+        with open_volume_writer(out_file, volume.shape, volume.dtype, compress, workers) as writer:
+            for z in range(volume.shape[0]):
+                writer.write_slice(z, volume[z])
+        data_filename, compressed_size = writer.data_filename, writer.compressed_size
+    else:
+        data_filename, compressed_size = out_file + ".raw", None
+        volume.tofile(data_filename)
+    mhd_filename = write_mhd_header(metadata, out_file, data_filename, compressed_size)
+    print(f"RawデータとMHDヘッダーを {data_filename} と {mhd_filename} に保存しました。")
+
+def convert_series(
+    sorted_entries,
+    out_file,
+    wl=40.0,
+    ww=400.0,
+    workers=None,
+    element_type="uchar",
+    stream=False,
+    compress=False,
+    isotropic=None,
+    mip=False,
+    decode_backend="auto",
+    reorder_window=None,
+    presets=None,
+):
+    """1シリーズ分のDicomEntryをMHD/RAWに変換
+
+    isotropic指定時は等方化したボリュームを、mip指定時は3方向のMIPを同じ走査で作成して保存する。
+    presets（(名前, WL, WW)の一覧）を指定したCT画像は、プリセットごとに<出力名>_<名前>として保存する。
+    """
+    if presets and sorted_entries[0].modality != "CT":
+        print("ウィンドウプリセットはCT画像のみ対応のため、通常の変換を行います。", file=sys.stderr)
+        presets = None
+    if presets:
+        mips = [MipAccumulator(len(sorted_entries)) for _ in presets] if mip else None
+        outputs = create_preset_volumes(
+            sorted_entries, presets, out_file, workers, compress, mips, decode_backend, reorder_window
+        )
+    else:
+        accumulator = MipAccumulator(len(sorted_entries)) if mip else None
+        mips = [accumulator] if mip else None
+        if stream:
+            metadata = create_volume_streaming(
+                sorted_entries, wl, ww, out_file, workers, element_type, compress, accumulator, decode_backend, reorder_window
+            )
+        else:
+            volume, metadata = create_volume(
+                sorted_entries, wl, ww, workers, element_type, accumulator, decode_backend, reorder_window
+            )
+            write_raw_mhd(volume, metadata, out_file, compress, workers)
+            del volume
+        outputs = [(out_file, metadata)]
+    positions = slice_positions(sorted_entries) if isotropic is not None and len(sorted_entries) > 1 else None
+    for i, (name, metadata) in enumerate(outputs):
+        if mips is not None:
+            saved = mips[i].save(name, metadata["ElementSpacing"], metadata["ElementType"])
+            print(f"MIP画像を {', '.join(saved)} に保存しました。")
+        if isotropic is not None:
+            resample_mhd(name + ".mhd", name + "_iso", isotropic, positions, compress)
+
+def convert_all_series(series, out_file, jobs=None, **options):
+    """複数シリーズをプロセスプールで並列に変換し、(UID, 出力ファイル名, 例外またはNone)の一覧を返す
+
+    jobsが1の場合はプロセスを起動せず順に変換する。
+    """
+    out_files = series_out_files(series, out_file)
+    if len(series) == 1:
+        convert_series(series[0][1], out_files[0], **options)
+        return [(series[0][0], out_files[0], None)]
+    results = []
+    if jobs == 1:
+        for (uid, entries), name in zip(series, out_files):
+            try:
+                convert_series(entries, name, **options)
+                results.append((uid, name, None))
+            except Exception as e:
+                results.append((uid, name, e))
+        return results
+    with ProcessPoolExecutor(max_workers=jobs or min(len(series), os.cpu_count() or 1)) as executor:
+        futures = [
+            (uid, name, executor.submit(convert_series, entries, name, **options))
+            for (uid, entries), name in zip(series, out_files)
+        ]
+        for uid, name, future in futures:
+            try:
+                future.result()
+                results.append((uid, name, None))
+            except Exception as e:
+                results.append((uid, name, e))
+    return results
+
+def resolve_input(in_folder, extract=False):
+    """入力を確認し、(読み込むパス, 削除が必要な一時ディレクトリまたはNone)を返す"""
+    if not os.path.exists(in_folder):
+        raise FileNotFoundError(f"入力フォルダまたはファイル{in_folder}が存在しません。")
+    if os.path.isfile(in_folder) and in_folder.lower().endswith(".zip"):
+        if extract:
+            temp_dir = extract_zip(in_folder)
+            return temp_dir, temp_dir
+        return in_folder, None
+    if os.path.isdir(in_folder):
+        return in_folder, None
+    raise ValueError(f"入力{in_folder}はフォルダでもZIPファイルでもありません。")
+
+def convert_study(in_folder, out_file, index=False, index_file=None, jobs=None, extract=False, **options):
+    """1検査分のフォルダまたはZIPを変換し、(シリーズごとの結果, DicomEntry一覧)を返す
+
+    optionsはconvert_seriesにそのまま渡す。
+    """
+    temp_dir = None
+    try:
+        in_path, temp_dir = resolve_input(in_folder, extract)
+        if index and index_file is None:
+            index_file = default_index_file(in_folder)
+        sorted_entries = get_instance_number(in_path, options.get("workers"), index_file)
+        series = group_series(sorted_entries)
+        if len(series) > 1:
+            print(f"{len(series)}個のシリーズが見つかりました。シリーズごとに変換します。")
+        return convert_all_series(series, out_file, jobs, **options), sorted_entries
+    finally:
+        if temp_dir and os.path.isdir(temp_dir):
+            shutil.rmtree(temp_dir)
+
+def add_conversion_arguments(parser):
+    """変換オプションのコマンドライン引数を追加する（main.pyとbatch.pyで共通）"""
+    parser.add_argument("--wl", type=float, default=40.0, help="ウィンドウレベル（CT画像のみ）")
+    parser.add_argument("--ww", type=float, default=400.0, help="ウィンドウ幅（CT画像のみ）")
+    parser.add_argument("--workers", type=int, default=None, help="ヘッダー読み込み・デコードの並列数（省略時はCPU数に応じて自動）")
+    parser.add_argument("--index", action="store_true", help="ヘッダー解析結果を入力の隣のSQLiteファイルに保存し、次回以降は再利用する")
+    parser.add_argument(
+        "--element-type",
+        choices=sorted(ELEMENT_TYPES),
+        default="uchar",
+        help="出力データ型（uchar: ウィンドウ処理後の256階調, short/float: HU値をそのまま保存）",
+    )
+    parser.add_argument("--stream", action="store_true", help="スライスごとに.rawのメモリマップへ書き込み、メモリ使用量を抑える")
+    parser.add_argument("--compress", action="store_true", help="CompressedData形式（.zraw）で保存する（チャンクごとに並列圧縮）")
+    parser.add_argument("--isotropic", type=float, default=None, help="指定したボクセルサイズ[mm]に等方化したボリュームを<出力名>_isoとして保存")
+    parser.add_argument("--mip", action="store_true", help="変換と同じ走査で体軸・冠状・矢状方向のMIPを作成し、<出力名>_mip_*として保存")
+    parser.add_argument(
+        "--presets",
+        type=parse_window_presets,
+        default=None,
+        help="複数のウィンドウで同時に出力（例: lung,mediastinum,bone,60:150）。1回のデコードで<出力名>_<名前>を保存",
+    )
+    parser.add_argument(
+        "--decode-backend",
+        choices=["auto", "thread", "process"],
+        default="auto",
+        help="画素データのデコード方式（auto: 圧縮転送構文ならプロセス、それ以外はスレッド）",
+    )
+    parser.add_argument("--reorder-window", type=int, default=None, help="デコードの先読み枚数の上限（省略時は並列数の2倍）")
+    parser.add_argument("--extract-zip", action="store_true", help="ZIPを一時ディレクトリに展開してから読み込む（従来の動作）")
+
+def conversion_options(args):
+    """コマンドライン引数からconvert_studyに渡すオプションの辞書を作成"""
+    return {
+        "index": args.index,
+        "extract": args.extract_zip,
+        "wl": args.wl,
+        "ww": args.ww,
+        "workers": args.workers,
+        "element_type": args.element_type,
+        "stream": args.stream,
+        "compress": args.compress,
+        "isotropic": args.isotropic,
+        "mip": args.mip,
+        "decode_backend": args.decode_backend,
+        "reorder_window": args.reorder_window,
+        "presets": args.presets,
     }
-    return volume_scaled, metadata
-
-def write_raw_mhd(volume, metadata, out_file):
-    """ボリュームデータをMHD/RAW形式で保存"""
-    raw_filename = out_file + ".raw"
-    mhd_filename = out_file + ".mhd"
-    volume.tofile(raw_filename)
-    with open(mhd_filename, "w") as f:
-        f.write("ObjectType = Image\n")
-        f.write("NDims = 3\n")
-        f.write(f"DimSize = {' '.join(map(str, metadata['DimSize']))}\n")
-        f.write(f"ElementType = {metadata['ElementType']}\n")
-        f.write(f"ElementSpacing = {' '.join(map(str, metadata['ElementSpacing']))}\n")
-        f.write("ElementByteOrderMSB = False\n")
-        f.write(f"ElementDataFile = {os.path.basename(raw_filename)}\n")
-    print(f"RawデータとMHDヘッダーを {raw_filename} と {mhd_filename} に保存しました。")
 
 def main():
     parser = argparse.ArgumentParser(
@@ -124,35 +690,31 @@ def main():
     )
     parser.add_argument("in_folder", type=str, help="入力フォルダ名またはZIPファイル名")
     parser.add_argument("out_file", type=str, help="出力ファイル名（拡張子不要）")
-    parser.add_argument("--wl", type=float, default=40.0, help="ウィンドウレベル（CT画像のみ）")
-    parser.add_argument("--ww", type=float, default=400.0, help="ウィンドウ幅（CT画像のみ）")
+    add_conversion_arguments(parser)
+    parser.add_argument("--index-file", type=str, default=None, help="ヘッダーインデックスのファイル名（--indexの保存先を変更）")
+    parser.add_argument("--jobs", type=int, default=None, help="複数シリーズを並列に変換するプロセス数（省略時はシリーズ数とCPU数の小さい方）")
     args = parser.parse_args()
 
     if not os.path.exists(args.in_folder):
         print(f"入力フォルダまたはファイル{args.in_folder}が存在しません。", file=sys.stderr)
         sys.exit(1)
 
-    temp_dir = None
-    extracted = False
     try:
-        if os.path.isfile(args.in_folder) and args.in_folder.lower().endswith(".zip"):
-            temp_dir = extract_zip(args.in_folder)
-            extracted = True
-        elif os.path.isdir(args.in_folder):
-            temp_dir = args.in_folder
-        else:
-            print(f"入力{args.in_folder}はフォルダでもZIPファイルでもありません。", file=sys.stderr)
-            sys.exit(1)
-
-        sorted_files = get_instance_number(temp_dir)
-        volume, metadata = create_volume(sorted_files, args.wl, args.ww)
-        write_raw_mhd(volume, metadata, args.out_file)
+        results, _ = convert_study(
+            args.in_folder,
+            args.out_file,
+            index_file=args.index_file,
+            jobs=args.jobs,
+            **conversion_options(args),
+        )
     except Exception as e:
         print(f"エラー: {e}", file=sys.stderr)
         sys.exit(1)
-    finally:
-        if extracted and temp_dir and os.path.isdir(temp_dir):
-            shutil.rmtree(temp_dir)
+    failed = [(uid, name, e) for uid, name, e in results if e is not None]
+    for uid, name, e in failed:
+        print(f"シリーズ{uid}（{name}）の変換に失敗しました: {e}", file=sys.stderr)
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
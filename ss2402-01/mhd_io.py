@@ -0,0 +1,276 @@
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# 圧縮時に1チャンクへまとめるおおよそのバイト数
+CHUNK_BYTES = 4 * 1024 * 1024
+
+_ADLER_BASE = 65521
+
+# MHDのElementTypeとnumpyの型の対応
+MET_TYPES = {
+    "MET_CHAR": np.int8,
+    "MET_UCHAR": np.uint8,
+    "MET_SHORT": np.int16,
+    "MET_USHORT": np.uint16,
+    "MET_INT": np.int32,
+    "MET_UINT": np.uint32,
+    "MET_LONG": np.int64,
+    "MET_ULONG": np.uint64,
+    "MET_FLOAT": np.float32,
+    "MET_DOUBLE": np.float64,
+}
+
+def write_mhd_header(metadata, out_file, data_file=None, compressed_size=None):
+    """MHDヘッダーを書き込み、ファイル名を返す（compressed_size指定時はCompressedData形式）"""
+    mhd_filename = out_file + ".mhd"
+    if data_file is None:
+        data_file = out_file + ".raw"
+    with open(mhd_filename, "w") as f:
+        f.write("ObjectType = Image\n")
+        f.write(f"NDims = {len(metadata['DimSize'])}\n")
+        f.write(f"DimSize = {' '.join(map(str, metadata['DimSize']))}\n")
+        f.write(f"ElementType = {metadata['ElementType']}\n")
+        f.write(f"ElementSpacing = {' '.join(map(str, metadata['ElementSpacing']))}\n")
+        f.write("ElementByteOrderMSB = False\n")
+        if compressed_size is not None:
+            f.write("CompressedData = True\n")
+            f.write(f"CompressedDataSize = {compressed_size}\n")
+        f.write(f"ElementDataFile = {os.path.basename(data_file)}\n")
+    return mhd_filename
+
+def adler32_combine(adler1, adler2, len2):
+    """連続する2つのデータのAdler-32を結合する（zlibのadler32_combineと同じ計算）"""
+    rem = len2 % _ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % _ADLER_BASE
+    sum1 += (adler2 & 0xFFFF) + _ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xFFFF) + ((adler2 >> 16) & 0xFFFF) + _ADLER_BASE - rem
+    sum1 %= _ADLER_BASE
+    sum2 %= _ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+def _zlib_header(level):
+    """圧縮レベルに対応するzlibストリームの2バイトヘッダーを返す"""
+    flevel = 0 if level == 1 else 1 if level < 6 else 2 if level == 6 else 3
+    cmf = 0x78
+    flg = flevel << 6
+    flg += 31 - ((cmf * 256 + flg) % 31)
+    return bytes([cmf, flg])
+
+def _compress_chunk(data, level, last):
+    """1チャンクを独立したdeflateブロック列に圧縮し、(圧縮データ, Adler-32, 元サイズ)を返す
+
+    最後以外のチャンクはZ_SYNC_FLUSHでバイト境界に揃えて終えるため、連結すると1つのdeflateストリームになる。
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return body, zlib.adler32(data), len(data)
+
+class RawVolumeWriter:
+    """np.memmapで確保した.rawファイルへスライス単位で書き込むクラス"""
+
+    def __init__(self, raw_filename, shape, dtype):
+        self.data_filename = raw_filename
+        self.compressed_size = None
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._volume = np.memmap(raw_filename, dtype=self.dtype, mode="w+", shape=self.shape)
+
+    def write_slice(self, z, img):
+        """z番目のスライスを書き込む"""
+        self._volume[z] = img
+
+    def close(self, num_slices=None):
+        """書き込みを確定し、num_slices枚に満たない場合はファイルを切り詰める"""
+        if self._volume is None:
+            return
+        self._volume.flush()
+        self._volume = None
+        if num_slices is not None and num_slices < self.shape[0]:
+            slice_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+            os.truncate(self.data_filename, num_slices * slice_bytes)
+            self.shape = (num_slices,) + self.shape[1:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class ZrawVolumeWriter:
+    """スライスを順に受け取り、チャンクごとに並列圧縮して.zrawファイルへ書き込むクラス
+
+    各チャンクは独立に圧縮して連結し、Adler-32を結合して1つの有効なzlibストリームとする。
+    """
+
+    def __init__(self, zraw_filename, shape, dtype, level=1, workers=None, chunk_bytes=CHUNK_BYTES):
+        self.data_filename = zraw_filename
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.level = level
+        self.chunk_bytes = chunk_bytes
+        self.compressed_size = 0
+        self._next_z = 0
+        self._buffer = []
+        self._buffered = 0
+        self._adler = 1
+        self._file = open(zraw_filename, "wb")
+        self._file.write(_zlib_header(level))
+        self.compressed_size += 2
+        workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._window = 2 * workers
+        self._pending = deque()
+
+    def write_slice(self, z, img):
+        """z番目のスライスを書き込む（スライスは先頭から順に渡す必要がある）"""
+        if z != self._next_z:
+            raise ValueError("圧縮出力ではスライスを先頭から順に書き込む必要があります。")
+        data = np.ascontiguousarray(img, dtype=self.dtype).tobytes()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._next_z += 1
+        if self._buffered >= self.chunk_bytes:
+            self._submit(last=False)
+
+    def _submit(self, last):
+        """バッファに溜めたスライスを1チャンクとして圧縮に回す"""
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._executor.submit(_compress_chunk, data, self.level, last))
+        while len(self._pending) > (0 if last else self._window):
+            self._write_chunk(self._pending.popleft().result())
+
+    def _write_chunk(self, result):
+        """圧縮済みチャンクを順に書き込み、チェックサムを結合する"""
+        body, adler, length = result
+        self._file.write(body)
+        self.compressed_size += len(body)
+        self._adler = adler32_combine(self._adler, adler, length)
+
+    def close(self, num_slices=None):
+        """残りのチャンクを圧縮してzlibストリームを完成させる"""
+        if self._file is None:
+            return
+        try:
+            self._submit(last=True)
+            self._file.write(self._adler.to_bytes(4, "big"))
+            self.compressed_size += 4
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+            self._file = None
+        self.shape = (self._next_z,) + self.shape[1:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def open_volume_writer(out_file, shape, dtype, compress=False, workers=None):
+    """出力形式に応じて.raw（メモリマップ）または.zraw（並列圧縮）の書き込みクラスを返す"""
+    if compress:
+        return ZrawVolumeWriter(out_file + ".zraw", shape, dtype, workers=workers)
+    return RawVolumeWriter(out_file + ".raw", shape, dtype)
+
+def read_mhd_header(mhd_file):
+    """MHDヘッダーを読み込み、(項目の辞書, ヘッダー部のバイト数)を返す"""
+    header = {}
+    size = 0
+    with open(mhd_file, "rb") as f:
+        for line in f:
+            size += len(line)
+            text = line.decode("latin-1").strip()
+            if not text or "=" not in text:
+                continue
+            key, value = (part.strip() for part in text.split("=", 1))
+            header[key] = value
+            if key == "ElementDataFile":
+                break
+    if "ElementDataFile" not in header:
+        raise ValueError(f"{mhd_file}にElementDataFileがありません。")
+    return header, size
+
+class MhdVolume:
+    """MHD/RAWボリュームをメモリマップで参照するクラス
+
+    arrayは(z, y, x)順の配列（非圧縮ならnp.memmap）、spacingはMHDと同じ(x, y, z)順。
+    """
+
+    def __init__(self, array, spacing, element_type, offset=None, header=None):
+        self.array = array
+        self.spacing = spacing
+        self.element_type = element_type
+        self.offset = offset
+        self.header = header or {}
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def slice(self, z):
+        """z番目のスライスを返す（ファイルから必要な部分だけ読み込まれる）"""
+        return self.array[z]
+
+    def slab(self, z0, z1):
+        """[z0, z1)のスライスをまとめて返す"""
+        return self.array[z0:z1]
+
+    def iter_slabs(self, slab_size, halo=0):
+        """(開始z, 終了z, 前後にhalo枚を加えたスラブ)を順に返す"""
+        depth = self.array.shape[0]
+        for z0 in range(0, depth, slab_size):
+            z1 = min(z0 + slab_size, depth)
+            yield z0, z1, self.array[max(z0 - halo, 0):min(z1 + halo, depth)]
+
+def load_mhd(mhd_file, mode="r"):
+    """MHDヘッダーを解析し、データ部をコピーせずにnp.memmapとして参照するMhdVolumeを返す
+
+    CompressedData形式（.zraw）はメモリマップできないため、展開した配列を返す。
+    """
+    header, header_size = read_mhd_header(mhd_file)
+    element_type = header.get("ElementType")
+    if element_type not in MET_TYPES:
+        raise ValueError(f"未対応のElementTypeです: {element_type}")
+    dtype = np.dtype(MET_TYPES[element_type])
+    msb = header.get("ElementByteOrderMSB", header.get("BinaryDataByteOrderMSB", "False"))
+    dtype = dtype.newbyteorder(">" if msb.lower() == "true" else "<")
+    dims = [int(v) for v in header["DimSize"].split()]
+    channels = int(header.get("ElementNumberOfChannels", "1"))
+    shape = tuple(dims[::-1]) + ((channels,) if channels > 1 else ())
+    spacing_text = header.get("ElementSpacing", header.get("ElementSize"))
+    spacing = tuple(float(v) for v in spacing_text.split()) if spacing_text else (1.0,) * len(dims)
+    offset_text = header.get("Offset", header.get("Origin", header.get("Position")))
+    offset = tuple(float(v) for v in offset_text.split()) if offset_text else None
+
+    data_file = header["ElementDataFile"]
+    if data_file == "LOCAL":
+        data_file = mhd_file
+        data_offset = header_size
+    else:
+        data_file = os.path.join(os.path.dirname(os.path.abspath(mhd_file)), data_file)
+        data_offset = int(header.get("HeaderSize", "0"))
+    if data_offset < 0:
+        data_offset = os.path.getsize(data_file) - int(np.prod(shape)) * dtype.itemsize
+
+    if header.get("CompressedData", "False").lower() == "true":
+        with open(data_file, "rb") as f:
+            f.seek(data_offset)
+            data = zlib.decompress(f.read())
+        array = np.frombuffer(bytearray(data), dtype=dtype).reshape(shape)
+    else:
+        array = np.memmap(data_file, dtype=dtype, mode=mode, offset=data_offset, shape=shape)
+    return MhdVolume(array, spacing, element_type, offset, header)
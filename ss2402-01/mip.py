@@ -0,0 +1,52 @@
+import numpy as np
+
+from mhd_io import write_mhd_header
+
+class MipAccumulator:
+    """スライスを順に受け取り、体軸・冠状・矢状方向の最大値投影（MIP）を逐次更新するクラス
+
+    体軸方向は画素ごとの最大値、冠状・矢状方向は各スライスの列・行ごとの最大値を保持するため、
+    ボリューム全体を読み直さずに変換と同じ1回の走査でMIPが得られる。
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.count = 0
+        self.axial = None
+        self.coronal = None
+        self.sagittal = None
+
+    def add(self, z, img):
+        """z番目のスライスをMIPに反映する"""
+        if self.axial is None:
+            height, width = img.shape
+            self.axial = img.copy()
+            self.coronal = np.zeros((self.depth, width), dtype=img.dtype)
+            self.sagittal = np.zeros((self.depth, height), dtype=img.dtype)
+        else:
+            np.maximum(self.axial, img, out=self.axial)
+        self.coronal[z] = img.max(axis=0)
+        self.sagittal[z] = img.max(axis=1)
+        self.count = max(self.count, z + 1)
+
+    def save(self, out_file, spacing, element_type):
+        """3方向のMIPを2次元のMHD/RAWとして保存し、ファイル名の一覧を返す"""
+        if self.axial is None:
+            raise RuntimeError("MIPを作成するスライスがありません。")
+        spacing_x, spacing_y, spacing_z = spacing
+        images = [
+            ("axial", self.axial, [spacing_x, spacing_y]),
+            ("coronal", self.coronal[:self.count], [spacing_x, spacing_z]),
+            ("sagittal", self.sagittal[:self.count], [spacing_y, spacing_z]),
+        ]
+        saved = []
+        for name, image, image_spacing in images:
+            mip_file = f"{out_file}_mip_{name}"
+            image.tofile(mip_file + ".raw")
+            metadata = {
+                "DimSize": list(image.shape[::-1]),
+                "ElementSpacing": image_spacing,
+                "ElementType": element_type,
+            }
+            saved.append(write_mhd_header(metadata, mip_file))
+        return saved
@@ -0,0 +1,130 @@
+import argparse
+import sys
+
+import numpy as np
+
+from mhd_io import load_mhd, open_volume_writer, write_mhd_header
+
+# 3次畳み込み補間のパラメータ（ss2407のTricubic補間と同じ値）
+CUBIC_A = -0.5
+
+def cubic_kernel(t, a=CUBIC_A):
+    """h(t)関数（Keysの3次畳み込み補間カーネル）"""
+    t = np.abs(t)
+    t2 = t * t
+    t3 = t2 * t
+    near = (a + 2) * t3 - (a + 3) * t2 + 1
+    far = a * t3 - 5 * a * t2 + 8 * a * t - 4 * a
+    return np.where(t <= 1, near, np.where(t <= 2, far, 0)).astype(np.float32)
+
+def interpolate_axis(data, coords, axis, start=0, size=None, a=CUBIC_A):
+    """dataのaxis方向を小数インデックスcoordsで3次補間する（範囲外は端の値で補う）
+
+    dataが全体のstart番目から始まる部分配列の場合は、全体の長さsizeを指定する。
+    """
+    if size is None:
+        size = data.shape[axis] + start
+    base = np.floor(coords).astype(np.int64)
+    t = coords - base
+    shape = [1] * data.ndim
+    shape[axis] = len(coords)
+    result = None
+    for k in range(4):
+        index = np.clip(base - 1 + k, 0, size - 1) - start
+        term = np.take(data, index, axis=axis) * cubic_kernel(t - k + 1, a).reshape(shape)
+        result = term if result is None else result + term
+    return result
+
+def output_coords(length, spacing, target, positions=None):
+    """出力ボクセルに対応する入力の小数インデックスを返す
+
+    positionsを指定した場合は各スライスの実際の位置から求める（間隔が一定でない場合に対応）。
+    """
+    if positions is None:
+        extent = (length - 1) * spacing
+        count = int(extent / target + 1e-6) + 1
+        return np.arange(count) * (target / spacing)
+    positions = np.asarray(positions, dtype=np.float64)
+    direction = 1.0 if positions[-1] >= positions[0] else -1.0
+    ordered = positions * direction
+    if np.any(np.diff(ordered) <= 0):
+        raise ValueError("スライス位置が単調に並んでいないため補間できません。")
+    count = int((ordered[-1] - ordered[0]) / target + 1e-6) + 1
+    targets = ordered[0] + np.arange(count) * target
+    return np.interp(targets, ordered, np.arange(length))
+
+def cast_output(img, dtype):
+    """補間結果を出力データ型に変換（整数型は四捨五入して値域に収める）"""
+    dtype = np.dtype(dtype)
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        return np.clip(np.rint(img), info.min, info.max).astype(dtype)
+    return img.astype(dtype)
+
+def resample_isotropic(volume, spacing, target, writer, z_positions=None, slab_size=16):
+    """(z, y, x)順のボリュームを等方ボクセルに3次補間し、スラブごとにwriterへ書き込む
+
+    出力をslab_size枚ずつ処理し、各スラブで必要な入力スライスだけを読み込むため、
+    メモリ使用量はボリューム全体ではなくスラブの大きさで決まる。出力の(z, y, x)サイズを返す。
+    """
+    depth, height, width = volume.shape
+    spacing_x, spacing_y, spacing_z = spacing
+    x_coords = output_coords(width, spacing_x, target)
+    y_coords = output_coords(height, spacing_y, target)
+    z_coords = output_coords(depth, spacing_z, target, z_positions)
+    for k0 in range(0, len(z_coords), slab_size):
+        coords = z_coords[k0:k0 + slab_size]
+        lo = max(int(np.floor(coords.min())) - 1, 0)
+        hi = min(int(np.floor(coords.max())) + 3, depth)
+        slab = np.asarray(volume[lo:hi], dtype=np.float32)
+        slab = interpolate_axis(slab, coords, 0, lo, depth)
+        slab = interpolate_axis(slab, y_coords, 1)
+        slab = interpolate_axis(slab, x_coords, 2)
+        slab = cast_output(slab, writer.dtype)
+        for i in range(slab.shape[0]):
+            writer.write_slice(k0 + i, slab[i])
+    return len(z_coords), len(y_coords), len(x_coords)
+
+def resample_mhd(in_mhd, out_file, target=1.0, z_positions=None, compress=False, slab_size=16):
+    """MHD/RAWボリュームを等方化してMHD/RAWとして保存"""
+    volume = load_mhd(in_mhd)
+    if volume.array.ndim != 3:
+        raise ValueError("3次元のボリュームのみ等方化できます。")
+    if z_positions is not None and len(z_positions) != volume.shape[0]:
+        print("スライス位置の数がボリュームと一致しないため、ElementSpacingを使用します。", file=sys.stderr)
+        z_positions = None
+    shape = (
+        len(output_coords(volume.shape[0], volume.spacing[2], target, z_positions)),
+        len(output_coords(volume.shape[1], volume.spacing[1], target)),
+        len(output_coords(volume.shape[2], volume.spacing[0], target)),
+    )
+    with open_volume_writer(out_file, shape, volume.dtype, compress) as writer:
+        resample_isotropic(volume.array, volume.spacing, target, writer, z_positions, slab_size)
+    metadata = {
+        "DimSize": list(shape[::-1]),
+        "ElementSpacing": [target, target, target],
+        "ElementType": volume.element_type,
+    }
+    mhd_filename = write_mhd_header(metadata, out_file, writer.data_filename, writer.compressed_size)
+    print(f"等方化したボリュームを {writer.data_filename} と {mhd_filename} に保存しました。")
+    return metadata
+
+def main():
+    parser = argparse.ArgumentParser(description="MHD/RAWボリュームを3次補間で等方化")
+    parser.add_argument("in_mhd", type=str, help="入力MHDファイル名")
+    parser.add_argument("out_file", type=str, help="出力ファイル名（拡張子不要）")
+    parser.add_argument("--spacing", type=float, default=1.0, help="等方化後のボクセルサイズ[mm]")
+    parser.add_argument("--slab", type=int, default=16, help="一度に処理する出力スライス数")
+    parser.add_argument("--compress", action="store_true", help="CompressedData形式（.zraw）で保存する")
+    args = parser.parse_args()
+    if args.spacing <= 0:
+        print("分解能は0より大きい値である必要があります。", file=sys.stderr)
+        sys.exit(1)
+    try:
+        resample_mhd(args.in_mhd, args.out_file, args.spacing, compress=args.compress, slab_size=args.slab)
+    except Exception as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import argparse
+import io
+import os
+import sys
+import zipfile
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import (
+    CTImageStorage,
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+    JPEG2000Lossless,
+    JPEGLSLossless,
+    MRImageStorage,
+    RLELossless,
+    generate_uid,
+)
+
+# 転送構文（コマンドライン指定名 → UID）。explicit/implicit以外はpydicomのエンコーダ（RLE以外は追加のプラグイン）が必要
+TRANSFER_SYNTAXES = {
+    "explicit": ExplicitVRLittleEndian,
+    "implicit": ImplicitVRLittleEndian,
+    "rle": RLELossless,
+    "jpeg-ls": JPEGLSLossless,
+    "jpeg2000": JPEG2000Lossless,
+}
+
+SOP_CLASSES = {"CT": CTImageStorage, "MR": MRImageStorage}
+
+def phantom_slice(rows, cols, z, slices, modality="CT", rng=None):
+    """体幹を模した楕円ファントムの1スライス（CTはHU値、MRは信号値）を返す
+
+    空気・軟部組織・左右の肺・骨の輪を含み、zに応じて断面の大きさが変わる。
+    """
+    y, x = np.mgrid[0:rows, 0:cols].astype(np.float32)
+    cy, cx = rows / 2, cols / 2
+    scale = 0.8 + 0.2 * np.sin(np.pi * (z + 0.5) / slices)
+    body = ((x - cx) / (0.45 * cols * scale)) ** 2 + ((y - cy) / (0.35 * rows * scale)) ** 2 <= 1
+    lung = np.zeros_like(body)
+    for side in (-1, 1):
+        lung |= ((x - cx - side * 0.18 * cols * scale) / (0.12 * cols * scale)) ** 2 + (
+            (y - cy) / (0.2 * rows * scale)
+        ) ** 2 <= 1
+    ring = ((x - cx) / (0.06 * cols)) ** 2 + ((y - cy - 0.22 * rows * scale) / (0.06 * rows)) ** 2
+    bone = (ring <= 1) & (ring >= 0.4)
+    if modality == "CT":
+        img = np.full((rows, cols), -1000.0, dtype=np.float32)
+        img[body] = 40.0
+        img[body & lung] = -800.0
+        img[body & bone] = 1000.0
+        noise = 20.0
+    else:
+        img = np.zeros((rows, cols), dtype=np.float32)
+        img[body] = 600.0
+        img[body & lung] = 50.0
+        img[body & bone] = 200.0
+        noise = 15.0
+    rng = rng or np.random.default_rng(z)
+    return img + rng.normal(0, noise, img.shape).astype(np.float32)
+
+def make_dataset(pixels, index, series_uid, study_uid, series_number, modality, spacing, thickness):
+    """画素配列とスライス位置からDICOMデータセットを作成（CTは格納値=HU+1024のuint16）"""
+    fm = FileMetaDataset()
+    fm.MediaStorageSOPClassUID = SOP_CLASSES[modality]
+    fm.MediaStorageSOPInstanceUID = generate_uid()
+    fm.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = fm
+    ds.SOPClassUID = fm.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = fm.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series_number
+    ds.InstanceNumber = index + 1
+    ds.Modality = modality
+    position = -thickness * index
+    ds.SliceLocation = position
+    ds.ImagePositionPatient = [-spacing * pixels.shape[1] / 2, -spacing * pixels.shape[0] / 2, position]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [spacing, spacing]
+    ds.SliceThickness = thickness
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    if modality == "CT":
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        pixels = pixels + 1024
+    ds.PixelData = np.clip(np.rint(pixels), 0, 65535).astype(np.uint16).tobytes()
+    return ds
+
+def encode(ds, transfer_syntax):
+    """データセットを指定した転送構文で符号化する（圧縮はpydicomのエンコーダを使用）"""
+    uid = TRANSFER_SYNTAXES[transfer_syntax]
+    if uid.is_compressed:
+        ds.compress(uid)
+    else:
+        ds.file_meta.TransferSyntaxUID = uid
+    return ds
+
+def generate(
+    out_path,
+    slices=64,
+    matrix=512,
+    modality="CT",
+    transfer_syntax="explicit",
+    series=1,
+    packaging="folder",
+    spacing=0.7,
+    thickness=1.0,
+    seed=0,
+):
+    """合成DICOMシリーズを書き出し、作成したファイル数を返す
+
+    packagingが"zip"の場合はout_path（.zip）に、"folder"の場合はout_pathフォルダに保存する。
+    ファイルの並びはInstance Number順にならないようシャッフルする。
+    """
+    if modality not in SOP_CLASSES:
+        raise ValueError(f"未対応のモダリティです: {modality}")
+    if transfer_syntax not in TRANSFER_SYNTAXES:
+        raise ValueError(f"未対応の転送構文です: {transfer_syntax}")
+    rng = np.random.default_rng(seed)
+    study_uid = generate_uid()
+    archive = None
+    if packaging == "zip":
+        archive = zipfile.ZipFile(out_path, "w", zipfile.ZIP_STORED)
+    else:
+        os.makedirs(out_path, exist_ok=True)
+    count = 0
+    try:
+        for s in range(series):
+            series_uid = generate_uid()
+            for i in rng.permutation(slices):
+                pixels = phantom_slice(matrix, matrix, i, slices, modality, rng)
+                ds = make_dataset(pixels, int(i), series_uid, study_uid, s + 1, modality, spacing, thickness * (s + 1))
+                ds = encode(ds, transfer_syntax)
+                name = f"series{s + 1:02d}_{count:05d}.dcm"
+                if archive is not None:
+                    buffer = io.BytesIO()
+                    ds.save_as(buffer, enforce_file_format=True)
+                    archive.writestr(name, buffer.getvalue())
+                else:
+                    ds.save_as(os.path.join(out_path, name), enforce_file_format=True)
+                count += 1
+    finally:
+        if archive is not None:
+            archive.close()
+    return count
+
+def add_synth_arguments(parser):
+    """合成データのコマンドライン引数を追加する（synth.pyとbenchmark.pyで共通）"""
+    parser.add_argument("--slices", type=int, default=64, help="1シリーズあたりのスライス数")
+    parser.add_argument("--matrix", type=int, default=512, help="1スライスの縦横の画素数")
+    parser.add_argument("--modality", choices=sorted(SOP_CLASSES), default="CT", help="モダリティ")
+    parser.add_argument("--transfer-syntax", choices=list(TRANSFER_SYNTAXES), default="explicit", help="転送構文")
+    parser.add_argument("--series", type=int, default=1, help="シリーズ数（シリーズごとにスライス厚を変える）")
+    parser.add_argument("--zip", action="store_true", help="フォルダではなくZIPファイルとして保存する")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+
+def synth_options(args):
+    """コマンドライン引数からgenerateに渡すオプションの辞書を作成"""
+    return {
+        "slices": args.slices,
+        "matrix": args.matrix,
+        "modality": args.modality,
+        "transfer_syntax": args.transfer_syntax,
+        "series": args.series,
+        "packaging": "zip" if args.zip else "folder",
+        "seed": args.seed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク・動作確認用の合成DICOMシリーズを作成")
+    parser.add_argument("out_path", type=str, help="出力フォルダ名（--zip指定時はZIPファイル名）")
+    add_synth_arguments(parser)
+    args = parser.parse_args()
+    try:
+        count = generate(args.out_path, **synth_options(args))
+    except Exception as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"{count}個のDICOMファイルを{args.out_path}に作成しました。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import bisect
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from main import _read_header_safe, add_conversion_arguments, conversion_options, convert_series
+
+class SeriesTracker:
+    """1シリーズ分の到着済みDicomEntryをInstance Number順に保持するクラス"""
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.entries = []
+        self._keys = []
+        self.last_arrival = 0.0
+        self.revision = 0
+        self.converted = 0
+
+    def add(self, entry, now):
+        """到着したDicomEntryを並び順を保ったまま追加する（同じファイルが書き換えられた場合は置き換える）"""
+        self.remove(entry.path)
+        index = bisect.bisect_right(self._keys, entry.instance_number)
+        self._keys.insert(index, entry.instance_number)
+        self.entries.insert(index, entry)
+        self.last_arrival = now
+        self.revision += 1
+
+    def remove(self, path):
+        """削除されたファイルのDicomEntryを取り除く（変換済みのシリーズは再変換しない）"""
+        for index, entry in enumerate(self.entries):
+            if entry.path == path:
+                del self.entries[index]
+                del self._keys[index]
+                return
+
+    def pending(self):
+        """前回の変換以降に新しいスライスが到着（または書き換え）されたか"""
+        return self.revision != self.converted
+
+    def out_name(self):
+        """出力ファイル名（拡張子なし）を返す"""
+        number = self.entries[0].series_number
+        return f"series{number}_{self.uid}" if number is not None else self.uid
+
+class DropWatcher:
+    """受信フォルダを定期的に確認し、シリーズごとに到着したDICOMのヘッダーを逐次解析するクラス
+
+    ファイルはサイズと更新時刻が2回続けて変わらなければ書き込み完了とみなしてヘッダーを解析する。
+    シリーズの最後のスライスからquiet秒新しいファイルが届かなければ、そのシリーズを完了として変換する。
+    """
+
+    def __init__(self, drop_dir, out_dir, quiet=5.0, workers=None, jobs=1, options=None):
+        self.drop_dir = drop_dir
+        self.out_dir = out_dir
+        self.quiet = quiet
+        self.workers = workers
+        self.jobs = jobs
+        self.options = options or {}
+        self.series = {}
+        self._observed = {}
+        self._done = {}
+        self._series_of = {}
+        self._running = {}
+
+    def scan(self, now):
+        """新しく書き込みが完了したファイルのヘッダーを解析し、シリーズに振り分ける"""
+        settled = []
+        seen = set()
+        for root, _, files in os.walk(self.drop_dir):
+            for f in files:
+                if not f.lower().endswith(".dcm"):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                seen.add(path)
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if self._done.get(path) == signature:
+                    continue
+                if self._observed.get(path) == signature:
+                    settled.append((path, signature))
+                else:
+                    self._observed[path] = signature
+        self._forget(seen)
+        if not settled:
+            return 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(_read_header_safe, [(path, None) for path, _ in settled])
+            for (path, signature), (_, entry) in zip(settled, results):
+                del self._observed[path]
+                self._done[path] = signature
+                self._remove_entry(path)
+                if entry is None:
+                    continue
+                self._series_of[path] = entry.series_uid
+                tracker = self.series.get(entry.series_uid)
+                if tracker is None:
+                    tracker = self.series[entry.series_uid] = SeriesTracker(entry.series_uid)
+                    print(f"シリーズ{entry.series_uid}の受信を開始しました。")
+                elif not tracker.pending():
+                    print(f"変換済みのシリーズ{entry.series_uid}にスライスが追加・更新されたため、再変換します。")
+                tracker.add(entry, now)
+        return len(settled)
+
+    def _remove_entry(self, path):
+        """解析済みのファイルをシリーズから取り除く"""
+        uid = self._series_of.pop(path, None)
+        if uid is not None and uid in self.series:
+            self.series[uid].remove(path)
+
+    def _forget(self, seen):
+        """受信フォルダから無くなったファイルと、空になったシリーズの記録を消す（長時間の監視でも増え続けないように）"""
+        for path in [p for p in self._observed if p not in seen]:
+            del self._observed[path]
+        for path in [p for p in self._done if p not in seen]:
+            del self._done[path]
+            self._remove_entry(path)
+        for uid in [u for u, t in self.series.items() if not t.entries and u not in self._running]:
+            del self.series[uid]
+
+    def ready(self, now):
+        """最後の到着からquiet秒以上経過し、変換待ちのシリーズを返す"""
+        return [
+            tracker
+            for uid, tracker in self.series.items()
+            if uid not in self._running and tracker.entries and tracker.pending() and now - tracker.last_arrival >= self.quiet
+        ]
+
+    def submit(self, executor, tracker, now):
+        """シリーズの変換をプロセスプールに登録する（並べ替えは到着時に済んでいる）"""
+        entries = list(tracker.entries)
+        out_file = os.path.join(self.out_dir, tracker.out_name())
+        print(f"シリーズ{tracker.uid}（{len(entries)}スライス）の受信が完了したとみなし、{out_file}へ変換します。")
+        future = executor.submit(convert_series, entries, out_file, workers=self.workers, **self.options)
+        self._running[tracker.uid] = (future, tracker.revision, now)
+
+    def collect(self, now):
+        """終了した変換の結果を表示する"""
+        for uid, (future, revision, last_arrival) in list(self._running.items()):
+            if not future.done():
+                continue
+            del self._running[uid]
+            if uid in self.series:
+                self.series[uid].converted = revision
+            try:
+                future.result()
+                print(f"シリーズ{uid}の変換が完了しました（最後の受信から{now - last_arrival:.1f}秒）。")
+            except Exception as e:
+                print(f"シリーズ{uid}の変換に失敗しました: {e}", file=sys.stderr)
+
+    def run(self, interval=1.0, once=False):
+        """受信フォルダの監視を続ける（onceの場合は現在のファイルを全て変換して終了）"""
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                now = time.monotonic()
+                self.scan(now)
+                self.collect(now)
+                for tracker in self.ready(now):
+                    self.submit(executor, tracker, tracker.last_arrival)
+                if once and not self._observed and not self._running and not any(
+                    t.pending() for t in self.series.values()
+                ):
+                    break
+                time.sleep(interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="受信フォルダを監視し、届いたDICOMシリーズを順次MHD/RAWに変換")
+    parser.add_argument("drop_dir", type=str, help="DICOMファイルが届く受信フォルダ")
+    parser.add_argument("out_dir", type=str, help="出力フォルダ")
+    add_conversion_arguments(parser)
+    parser.add_argument("--quiet", type=float, default=5.0, help="シリーズの完了とみなすまでの無受信時間[秒]")
+    parser.add_argument("--interval", type=float, default=1.0, help="受信フォルダを確認する間隔[秒]")
+    parser.add_argument("--jobs", type=int, default=1, help="同時に変換するシリーズ数")
+    parser.add_argument("--once", action="store_true", help="受信フォルダ内の全シリーズを変換したら終了する")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.drop_dir):
+        print(f"受信フォルダ{args.drop_dir}が存在しません。", file=sys.stderr)
+        sys.exit(1)
+    os.makedirs(args.out_dir, exist_ok=True)
+    options = conversion_options(args)
+    for key in ("index", "extract", "workers"):
+        del options[key]
+    watcher = DropWatcher(args.drop_dir, args.out_dir, args.quiet, args.workers, args.jobs, options)
+    print(f"{args.drop_dir}の監視を開始しました（Ctrl+Cで終了）。")
+    try:
+        watcher.run(args.interval, args.once)
+    except KeyboardInterrupt:
+        print("監視を終了しました。")
+
+if __name__ == "__main__":
+    main()
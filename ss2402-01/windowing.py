@@ -0,0 +1,108 @@
+from functools import lru_cache
+
+import numpy as np
+
+# 出力データ型（コマンドライン指定名 → MHDのElementTypeとnumpyの型）
+ELEMENT_TYPES = {
+    "uchar": ("MET_UCHAR", np.uint8),
+    "short": ("MET_SHORT", np.int16),
+    "float": ("MET_FLOAT", np.float32),
+}
+
+# よく使うCTのウィンドウ（名前 → (ウィンドウレベル, ウィンドウ幅)）
+WINDOW_PRESETS = {
+    "lung": (-600.0, 1500.0),
+    "mediastinum": (40.0, 400.0),
+    "bone": (400.0, 1800.0),
+    "brain": (40.0, 80.0),
+    "abdomen": (60.0, 400.0),
+}
+
+def window_to_uint8(img, min_val, max_val):
+    """[min_val, max_val]の範囲を256階調に正規化する"""
+    normalized = (img - min_val) / (max_val - min_val + 1e-8)
+    normalized = np.clip(normalized, 0, 1)
+    return (normalized * 255).astype(np.uint8)
+
+def to_short(img):
+    """HU値などの実数画像を四捨五入してint16に変換"""
+    return np.clip(np.rint(img), -32768, 32767).astype(np.int16)
+
+def lut_supported(dtype):
+    """変換テーブルで処理できる画素型（16bit以下の整数）か判定"""
+    dtype = np.dtype(dtype)
+    return dtype.kind in "iu" and dtype.itemsize <= 2 and dtype.isnative
+
+def _lut_inputs(dtype):
+    """符号なし整数として見た各インデックスに対応する画素値をfloat32で返す"""
+    dtype = np.dtype(dtype)
+    index = np.arange(1 << (8 * dtype.itemsize), dtype=f"u{dtype.itemsize}")
+    return index.view(dtype).astype(np.float32)
+
+@lru_cache(maxsize=32)
+def build_window_lut(dtype, slope, intercept, min_val, max_val):
+    """画素値→リスケール→ウィンドウ処理→uint8を1つの変換テーブルにまとめる"""
+    return window_to_uint8(slope * _lut_inputs(dtype) + intercept, min_val, max_val)
+
+@lru_cache(maxsize=32)
+def build_rescale_lut(dtype, slope, intercept):
+    """画素値→リスケール（HU値）→int16の変換テーブルを作成"""
+    return to_short(slope * _lut_inputs(dtype) + intercept)
+
+def apply_lut(pixels, lut):
+    """整数画素配列を符号なし整数として参照し、変換テーブルを1回で適用する"""
+    return lut[pixels.view(f"u{pixels.dtype.itemsize}")]
+
+def parse_window_presets(text):
+    """「lung,bone,60:150,liver=60:150」のような指定を(名前, WL, WW)の一覧に変換する
+
+    WL:WWだけを指定した場合は「wl60_ww150」のような名前を付ける。
+    """
+    presets = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, value = item.rpartition("=")
+        if ":" not in value:
+            if value not in WINDOW_PRESETS:
+                raise ValueError(f"未知のウィンドウプリセットです: {value}（{', '.join(WINDOW_PRESETS)}またはWL:WW）")
+            name = name or value
+            wl, ww = WINDOW_PRESETS[value]
+        else:
+            wl, ww = (float(v) for v in value.split(":", 1))
+            if ww <= 0:
+                raise ValueError(f"ウィンドウ幅は0より大きい値である必要があります: {item}")
+            name = name or f"wl{wl:g}_ww{ww:g}"
+        presets.append((name, wl, ww))
+    if not presets:
+        raise ValueError("ウィンドウプリセットが指定されていません。")
+    if len({name for name, _, _ in presets}) != len(presets):
+        raise ValueError("ウィンドウプリセットの名前が重複しています。")
+    return presets
+
+def convert_slice(pixels, slope, intercept, element_type, min_val=None, max_val=None):
+    """画素配列を出力データ型に変換する（16bit以下の整数は変換テーブルで処理）"""
+    if element_type != "float" and lut_supported(pixels.dtype):
+        if element_type == "uchar":
+            lut = build_window_lut(pixels.dtype, slope, intercept, min_val, max_val)
+        else:
+            lut = build_rescale_lut(pixels.dtype, slope, intercept)
+        return apply_lut(pixels, lut)
+    img = slope * pixels.astype(np.float32) + intercept
+    if element_type == "uchar":
+        return window_to_uint8(img, min_val, max_val)
+    if element_type == "short":
+        return to_short(img)
+    return img
+
+def window_slice_presets(pixels, slope, intercept, ranges):
+    """1枚の画素配列を複数のウィンドウ範囲[(min_val, max_val), ...]で256階調に変換する
+
+    16bit以下の整数はHU値変換を含めた変換テーブルを範囲ごとに適用し、
+    それ以外はHU値を1回だけ計算して各範囲に振り分ける。
+    """
+    if lut_supported(pixels.dtype):
+        return [apply_lut(pixels, build_window_lut(pixels.dtype, slope, intercept, lo, hi)) for lo, hi in ranges]
+    img = slope * pixels.astype(np.float32) + intercept
+    return [window_to_uint8(img, lo, hi) for lo, hi in ranges]
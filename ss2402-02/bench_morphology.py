@@ -0,0 +1,57 @@
+import argparse
+import time
+import numpy as np
+import SimpleITK as sitk
+from main import MORPH_ITERATIONS, MORPH_SIZE, auto_threshold, open_close
+
+def synthetic_volume(depth, size, seed=0):
+    """体幹・寝台・ノイズを含む合成CTボリューム（HU値）を作成"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    body = ((x - size / 2) / (0.4 * size)) ** 2 + ((y - size / 2) / (0.3 * size)) ** 2 <= 1
+    volume = np.full((depth, size, size), -1000, dtype=np.int16)
+    volume[:, body] = 40
+    volume[:, int(0.85 * size):int(0.88 * size), int(0.2 * size):int(0.8 * size)] = 100
+    return (volume + rng.normal(0, 300, volume.shape)).astype(np.int16)
+
+def time_call(func, repeat):
+    """funcをrepeat回実行し、(最短時間[秒], 結果)を返す"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description="開閉処理のndimage実装と分解（累積和）実装の速度比較")
+    parser.add_argument("input_nifti", nargs="?", default=None, help="入力NIfTIファイル（省略時は合成データ）")
+    parser.add_argument("--depth", type=int, default=64, help="合成データのスライス数")
+    parser.add_argument("--size", type=int, default=512, help="合成データの縦横の画素数")
+    parser.add_argument("--repeat", type=int, default=3, help="繰り返し回数（最短時間を表示）")
+    args = parser.parse_args()
+
+    if args.input_nifti:
+        volume = sitk.GetArrayFromImage(sitk.ReadImage(args.input_nifti))
+    else:
+        volume = synthetic_volume(args.depth, args.size)
+    bin_vol = auto_threshold(volume)
+    print(f"ボリューム: {volume.shape}, 構造要素: {MORPH_SIZE}x{MORPH_SIZE} x {MORPH_ITERATIONS}回")
+
+    results = {}
+    for name in ("ndimage", "separable"):
+        # スライスごと（process_sliceと同じ呼び出し方）とボリュームまとめて（process_volumeと同じ）の両方を計測
+        per_slice, masks = time_call(lambda: [open_close(img, name) for img in bin_vol], args.repeat)
+        whole, mask = time_call(lambda: open_close(bin_vol, name), args.repeat)
+        results[name] = (np.stack(masks), mask)
+        print(f"{name:>9}: スライスごと {per_slice:.3f}秒, ボリューム {whole:.3f}秒")
+
+    identical = all(np.array_equal(a, b) for a, b in zip(results["ndimage"], results["separable"]))
+    print(f"出力マスクの一致: {'一致' if identical else '不一致'}")
+    if not identical:
+        diff = int(np.count_nonzero(results["ndimage"][1] != results["separable"][1]))
+        print(f"異なる画素数: {diff}")
+
+if __name__ == "__main__":
+    main()
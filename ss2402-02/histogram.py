@@ -0,0 +1,251 @@
+import numpy as np
+import SimpleITK as sitk
+
+from nifti_io import NiftiSlabReader
+
+# 浮動小数点の画像で自動的に決めるビンの数と、ビンの数の上限（超える場合はビンの幅を2倍にしてまとめる）
+DEFAULT_BINS = 1024
+MAX_BINS = 1 << 16
+
+class StreamingStats:
+    """画素値のヒストグラム・平均・標準偏差を、データを分割して1回走査するだけで求めるクラス
+
+    ヒストグラムはbin_width刻みの整数のビンをnp.bincountで数える（範囲は必要に応じて広げる）。
+    bin_widthを省略すると、整数型の画像は1、浮動小数点型の画像は値の範囲をbins個に分ける2のべき乗の幅にする。
+    浮動小数点型で値が一定の分割（ゼロ埋めのスライスなど）しか届いていない間は、値ごとの画素数だけを保持し、
+    範囲が決まってから幅を決める。
+    値の範囲がmax_bins個を超える場合は隣り合うビンをまとめて幅を2倍にするため、メモリ使用量は一定以下に収まる。
+    整数値のデータを幅1のまま数えた場合、中央値・パーセンタイルはnp.percentileと一致する（exact=True）。
+    NaN・無限大の画素はヒストグラム・平均・標準偏差から除き、画素数だけをnonfiniteに数える。
+    平均・標準偏差はヒストグラムではなく、分割ごとの結果をWelford法（Chanの合成式）で合わせて求める
+    （閾値を求めるだけの場合などはmoments=Falseで省略できる）。
+    """
+
+    def __init__(self, bin_width=None, bins=DEFAULT_BINS, max_bins=MAX_BINS, moments=True):
+        if bin_width is not None and bin_width <= 0:
+            raise ValueError("ビンの幅は正の値を指定してください。")
+        if bins < 2 or max_bins < bins:
+            raise ValueError("ビンの数は2以上、上限以下を指定してください。")
+        self.bin_width = float(bin_width) if bin_width is not None else None
+        self.bins = bins
+        self.max_bins = max_bins
+        self.moments = moments
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._constants = {}
+        self.offset = 0
+        self.n = 0
+        self.nonfinite = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.exact = self.bin_width in (None, 1.0)
+
+    @property
+    def counts(self):
+        """各ビンの画素数（保持している一定値の分割があれば先にヒストグラムに加える）"""
+        self.finish()
+        return self._counts
+
+    def _range_width(self, lo, hi):
+        """値の範囲[lo, hi]をbins個に分ける2のべき乗の幅"""
+        return 2.0 ** np.ceil(np.log2((hi - lo) / self.bins))
+
+    def finish(self):
+        """一定値の分割しか届いていない場合、その値から幅を決めてヒストグラムに加える"""
+        if not self._constants:
+            return
+        if self.bin_width is None:
+            # 値が1つだけの場合：整数値なら幅1、それ以外は値の大きさのbins分の1程度の幅
+            value = next(iter(self._constants))
+            if float(value).is_integer():
+                self.bin_width = 1.0
+            else:
+                self.bin_width = 2.0 ** np.floor(np.log2(abs(value) / self.bins))
+                self.exact = False
+        constants, self._constants = self._constants, {}
+        self._count(np.array(list(constants)), np.array(list(constants.values()), dtype=np.int64))
+
+    def _span(self, vmin, vmax):
+        """現在のビンと新しい値の範囲を合わせたビンの数"""
+        lo = np.floor(float(vmin) / self.bin_width)
+        hi = np.floor(float(vmax) / self.bin_width)
+        if len(self._counts):
+            lo = min(lo, self.offset)
+            hi = max(hi, self.offset + len(self._counts) - 1)
+        return hi - lo + 1
+
+    def _coarsen(self):
+        """隣り合う2つのビンをまとめ、ビンの幅を2倍にする"""
+        if len(self._counts):
+            offset = self.offset >> 1
+            index = ((self.offset + np.arange(len(self._counts))) >> 1) - offset
+            self._counts = np.bincount(index, weights=self._counts).astype(np.int64)
+            self.offset = offset
+        self.bin_width *= 2
+        self.exact = False
+
+    def _keys(self, values):
+        """画素値をビンの番号（整数）に変換する"""
+        if np.issubdtype(values.dtype, np.integer) and self.bin_width.is_integer():
+            return values.astype(np.int64) // int(self.bin_width)
+        keys = np.floor(values / self.bin_width)
+        if self.exact and not np.array_equal(keys, values):
+            self.exact = False
+        return keys.astype(np.int64)
+
+    def _count(self, values, weights=None):
+        """画素値（weightsを指定した場合は値ごとの画素数）をヒストグラムに加える"""
+        vmin, vmax = values.min(), values.max()
+        while self._span(vmin, vmax) > self.max_bins:
+            self._coarsen()
+        keys = self._keys(values)
+        lo, hi = int(keys.min()), int(keys.max())
+        if not len(self._counts):
+            self.offset = lo
+        elif lo < self.offset or hi >= self.offset + len(self._counts):
+            start = min(lo, self.offset)
+            counts = np.zeros(max(hi, self.offset + len(self._counts) - 1) - start + 1, dtype=np.int64)
+            counts[self.offset - start:self.offset - start + len(self._counts)] = self._counts
+            self._counts, self.offset = counts, start
+        counts = np.bincount(keys - self.offset, weights=weights, minlength=len(self._counts))
+        if weights is not None:
+            counts = counts.astype(np.int64)
+        self._counts = self._counts + counts if len(self._counts) else counts
+
+    def update(self, values):
+        """画素値の配列（スラブなど）を加える"""
+        values = np.asarray(values).ravel()
+        if not np.issubdtype(values.dtype, np.integer):
+            finite = np.isfinite(values)
+            if not finite.all():
+                self.nonfinite += int(values.size - np.count_nonzero(finite))
+                values = values[finite]
+        if values.size == 0:
+            return
+        if self.bin_width is None and np.issubdtype(values.dtype, np.integer):
+            self.bin_width = 1.0
+        if self.bin_width is None:
+            # 浮動小数点型：値の範囲が0より大きくなるまで幅を決めず、一定値の分割は値ごとの画素数だけ保持する
+            vmin, vmax = float(values.min()), float(values.max())
+            lo = min([vmin] + list(self._constants))
+            hi = max([vmax] + list(self._constants))
+            if lo == hi:
+                self._constants[vmin] = self._constants.get(vmin, 0) + values.size
+            else:
+                self.bin_width = self._range_width(lo, hi)
+                self.exact = self.bin_width == 1.0
+                self.finish()
+                self._count(values)
+        else:
+            self._count(values)
+
+        n = values.size
+        total = self.n + n
+        if self.moments:
+            # 分割ごとの平均・偏差平方和をChanの式で合わせる
+            mean = float(values.mean(dtype=np.float64))
+            m2 = float(np.square(values - mean, dtype=np.float64).sum())
+            delta = mean - self.mean
+            self.mean += delta * n / total
+            self.m2 += m2 + delta * delta * self.n * n / total
+        self.n = total
+
+    def values(self):
+        """各ビンの代表値を返す（exactの場合は画素値そのもの、それ以外はビンの中央）"""
+        self.finish()
+        index = self.offset + np.arange(len(self._counts))
+        return index * self.bin_width if self.exact else (index + 0.5) * self.bin_width
+
+    def std(self, ddof=0):
+        """標準偏差（np.stdと同じくddof=0が既定）"""
+        return float(np.sqrt(self.m2 / (self.n - ddof))) if self.n > ddof else float("nan")
+
+    def percentile(self, q):
+        """ヒストグラムの累積度数からパーセンタイルを求める（np.percentileと同じ線形補間）"""
+        if self.n == 0:
+            return float("nan")
+        cumulative = np.cumsum(self.counts)
+        rank = np.asarray(q, dtype=np.float64) / 100 * (self.n - 1)
+        lower = np.floor(rank)
+        values = self.values()
+        below = values[np.searchsorted(cumulative, lower, side="right")]
+        above = values[np.searchsorted(cumulative, np.minimum(lower + 1, self.n - 1), side="right")]
+        result = below + (above - below) * (rank - lower)
+        return float(result) if result.ndim == 0 else result
+
+    def median(self):
+        return self.percentile(50)
+
+    def minimum(self):
+        return float(self.values()[np.flatnonzero(self.counts)[0]]) if self.n else float("nan")
+
+    def maximum(self):
+        return float(self.values()[np.flatnonzero(self.counts)[-1]]) if self.n else float("nan")
+
+    def otsu_threshold(self):
+        """ヒストグラムから大津の方法（クラス間分散が最大）で閾値を求める
+
+        閾値より大きい画素を前景とする。exactでない場合はビンの上端を閾値とする。
+        """
+        if self.n == 0:
+            raise ValueError("ヒストグラムが空のため閾値を求められません。")
+        values = self.values()
+        weight = np.cumsum(self.counts, dtype=np.float64) / self.n
+        mean = np.cumsum(self.counts * values, dtype=np.float64) / self.n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            between = (mean[-1] * weight - mean) ** 2 / (weight * (1.0 - weight))
+        between[(weight <= 0) | (weight >= 1)] = -1.0
+        k = int(np.argmax(between))
+        return float(values[k]) if self.exact else float(values[k] + self.bin_width / 2)
+
+    def save(self, path):
+        """npz形式で保存する（体幹抽出の--histogramで再利用できる）"""
+        np.savez_compressed(
+            path,
+            counts=self.counts,
+            offset=self.offset,
+            bin_width=self.bin_width or 0.0,
+            bins=self.bins,
+            max_bins=self.max_bins,
+            n=self.n,
+            nonfinite=self.nonfinite,
+            mean=self.mean,
+            m2=self.m2,
+            exact=self.exact,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """saveで保存したnpzファイルを読み込む"""
+        with np.load(path) as f:
+            stats = cls(float(f["bin_width"]) or None, int(f["bins"]), int(f["max_bins"]))
+            stats._counts = f["counts"]
+            stats.offset = int(f["offset"])
+            stats.n = int(f["n"])
+            stats.nonfinite = int(f["nonfinite"]) if "nonfinite" in f.files else 0
+            stats.mean = float(f["mean"])
+            stats.m2 = float(f["m2"])
+            stats.exact = bool(f["exact"])
+        return stats
+
+def iter_volume_slabs(path, slab_size=32):
+    """画像をz方向のスラブごとに返す
+
+    NIfTI-1はNiftiSlabReaderでスラブ単位に読み込み、それ以外の形式はSimpleITKで全体を読み込んで分割する。
+    """
+    try:
+        reader = NiftiSlabReader(path)
+    except ValueError:
+        arr = sitk.GetArrayFromImage(sitk.ReadImage(path))
+        for z0 in range(0, arr.shape[0], slab_size):
+            yield arr[z0:z0 + slab_size]
+        return
+    with reader:
+        for _, _, slab in reader.iter_slabs(slab_size):
+            yield slab
+
+def volume_stats(path, slab_size=32, bin_width=None, bins=DEFAULT_BINS, moments=True):
+    """画像を1回走査してStreamingStatsを返す"""
+    stats = StreamingStats(bin_width, bins, moments=moments)
+    for slab in iter_volume_slabs(path, slab_size):
+        stats.update(slab)
+    return stats
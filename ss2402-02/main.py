@@ -1,62 +1,589 @@
 import argparse
+import json
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import SimpleITK as sitk
 from scipy import ndimage
 import matplotlib.pyplot as plt
+from morphology import box_closing, box_dilation, box_erosion, box_opening
+from nifti_io import NiftiMaskWriter, NiftiSlabReader
+from histogram import DEFAULT_BINS, StreamingStats, volume_stats
+from packed_mask import PackedMask
+from profiling import PROFILER
 
-def auto_threshold(slice_img):
+# 閾値処理の既定値（CT値）
+THRESHOLD = -700
+# 自動閾値の信頼性の目安となる、画素を含むビンの最小数（これより少ない場合は警告する）
+MIN_OCCUPIED_BINS = 3
+# 開閉処理の構造要素（一辺の画素数）と繰り返し回数
+MORPH_SIZE = 5
+MORPH_ITERATIONS = 2
+# ROIの余白（開閉処理で領域が広がる幅＋穴埋めで外側とつながる背景1画素 = 2*2+1）
+ROI_MARGIN = MORPH_ITERATIONS * (MORPH_SIZE // 2) + 1
+
+def auto_threshold(slice_img, thresh=THRESHOLD):
     """二値化処理の実施"""
-    thresh = -700
     return (slice_img > thresh).astype(np.uint8)
 
-def process_slice(slice_img):
+def open_close(bin_img, morphology="ndimage"):
+    """最後の2軸（y, x）の正方形構造要素でオープニング・クロージングを行う
+
+    morphology="separable"の場合は、正方形を行・列方向の1次元処理に分解し、累積和で計算する。
+    """
+    if morphology == "separable":
+        with PROFILER.stage("opening"):
+            bin_img = box_opening(bin_img, MORPH_SIZE, MORPH_ITERATIONS)
+        with PROFILER.stage("closing"):
+            return box_closing(bin_img, MORPH_SIZE, MORPH_ITERATIONS)
+    structure = np.ones((1,) * (bin_img.ndim - 2) + (MORPH_SIZE, MORPH_SIZE), dtype=np.uint8)
+    with PROFILER.stage("opening"):
+        bin_img = ndimage.binary_opening(bin_img, structure=structure, iterations=MORPH_ITERATIONS)
+    with PROFILER.stage("closing"):
+        return ndimage.binary_closing(bin_img, structure=structure, iterations=MORPH_ITERATIONS)
+
+def process_slice(slice_img, morphology="ndimage", threshold=THRESHOLD):
     """各断面画像の体幹抽出処理"""
     # 1. 閾値処理
-    bin_img = auto_threshold(slice_img)
+    with PROFILER.stage("threshold"):
+        bin_img = auto_threshold(slice_img, threshold)
 
     # 2. モルフォロジー処理（開閉＋穴埋め）
-    structure = np.ones((5, 5), dtype=np.uint8)
-    bin_img = ndimage.binary_opening(bin_img, structure=structure, iterations=2)
-    bin_img = ndimage.binary_closing(bin_img, structure=structure, iterations=2)
-    bin_img = ndimage.binary_fill_holes(bin_img)
+    bin_img = open_close(bin_img, morphology)
+    with PROFILER.stage("fill_holes"):
+        bin_img = ndimage.binary_fill_holes(bin_img)
 
     # 3. ラベリング（8近傍）
-    labeled, num = ndimage.label(bin_img, structure=np.ones((3, 3), dtype=np.uint8))
+    with PROFILER.stage("label"):
+        labeled, num = ndimage.label(bin_img, structure=np.ones((3, 3), dtype=np.uint8))
     if num == 0:
         return np.zeros_like(slice_img, dtype=np.uint8)
-    areas = ndimage.sum(bin_img, labeled, range(1, num + 1))
-    max_label = np.argmax(areas) + 1
-    mask = (labeled == max_label)
-    # 最大領域のみ白（1）、それ以外は黒（0）
-    print("mask数:", np.sum(mask))
-    return mask.astype(np.uint8)
-
-def extract_trunk(volume):
-    """各スライスごとに2Dラベリング最大領域のみ抽出"""
+    with PROFILER.stage("select"):
+        areas = ndimage.sum(bin_img, labeled, range(1, num + 1))
+        max_label = np.argmax(areas) + 1
+        # 最大領域のみ白（1）、それ以外は黒（0）
+        return (labeled == max_label).astype(np.uint8)
+
+def largest_per_slice(labeled, num):
+    """スライス内だけで連結するラベル画像から、各スライスの最大領域のみを1としたマスクを返す
+
+    ラベルはラスタ走査順に付くため、各スライスのラベルは連続した範囲になる。
+    面積はbincountで一度に求め、スライスごとの最大（同じ面積なら小さいラベル）をまとめて選ぶ。
+    """
+    if num == 0:
+        return np.zeros(labeled.shape, dtype=np.uint8)
+    areas = np.bincount(labeled.ravel(), minlength=num + 1)[1:]
+    # 各スライスの最大ラベル（領域のないスライスは直前の値を引き継ぐ）
+    ends = np.maximum.accumulate(labeled.reshape(labeled.shape[0], -1).max(axis=1))
+    labels = np.arange(1, num + 1)
+    slice_of_label = np.searchsorted(ends, labels)
+    order = np.lexsort((labels, -areas, slice_of_label))
+    _, first = np.unique(slice_of_label[order], return_index=True)
+    keep = np.zeros(num + 1, dtype=bool)
+    keep[labels[order[first]]] = True
+    return keep[labeled].astype(np.uint8)
+
+def process_volume(volume, morphology="ndimage", threshold=THRESHOLD):
+    """全スライスの体幹抽出処理をスライス内だけに広がる構造要素による3次元処理1回ずつで行う
+
+    z方向に広がらない構造要素を使うため、結果はprocess_sliceを各スライスに適用した場合と一致する。
+    """
+    # 1. 閾値処理
+    with PROFILER.stage("threshold"):
+        bin_vol = auto_threshold(volume, threshold)
+
+    # 2. モルフォロジー処理（開閉＋穴埋め）
+    bin_vol = open_close(bin_vol, morphology)
+    with PROFILER.stage("fill_holes"):
+        bin_vol = ndimage.binary_fill_holes(bin_vol, structure=ndimage.generate_binary_structure(2, 1)[np.newaxis])
+
+    # 3. ラベリング（スライス内の8近傍のみ。labelは各軸3の構造要素が必要なため中央の面だけを1にする）
+    label_structure = np.zeros((3, 3, 3), dtype=np.uint8)
+    label_structure[1] = 1
+    with PROFILER.stage("label"):
+        labeled, num = ndimage.label(bin_vol, structure=label_structure)
+    with PROFILER.stage("select"):
+        return largest_per_slice(labeled, num)
+
+# ワーカープロセスが開いている入力用・出力用の共有メモリ
+_worker_shms = {}
+
+def _attach_array(source, shape, dtype, role):
+    """("shm", 名前)なら共有メモリ、("memmap", ファイル名, オフセット)ならメモリマップとして配列を開く
+
+    共有メモリはrole（"input"または"output"）ごとに1つだけ開いたままにし、名前が変わった場合は開き直す。
+    """
+    if source[0] == "memmap":
+        return np.memmap(source[1], dtype=dtype, mode="r", offset=source[2], shape=shape)
+    shm = _worker_shms.get(role)
+    if shm is None or shm.name != source[1]:
+        if shm is not None:
+            shm.close()
+        shm = _worker_shms[role] = shared_memory.SharedMemory(name=source[1])
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _init_worker(profile=False):
+    """ワーカー起動時に計測の有無を設定する"""
+    if profile:
+        PROFILER.start()
+    else:
+        PROFILER.stop()
+
+def _process_slab(in_source, out_name, shape, dtype, z0, z1, morphology="ndimage", threshold=THRESHOLD):
+    """[z0, z1)のスライスを処理して共有の出力マスクに書き込む"""
+    volume = _attach_array(in_source, shape, dtype, "input")
+    trunk_mask = _attach_array(("shm", out_name), shape, np.uint8, "output")
+    trunk_mask[z0:z1] = process_volume(volume[z0:z1], morphology, threshold)
+    return PROFILER.take()
+
+class TrunkPool:
+    """体幹抽出のプロセスプールと入出力の共有メモリを保持し、複数のボリューム（スラブ）の処理に再利用するクラス
+
+    共有メモリは処理するボリュームより小さい場合だけ確保し直すため、同じ大きさのスラブを続けて処理する
+    --slabでは、プロセスの起動と共有メモリの確保は最初の1回だけになる。
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self._shms = {}
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker, initargs=(PROFILER.enabled,)
+        )
+
+    def _buffer(self, role, size):
+        """size以上の大きさの共有メモリを返す（足りなければ確保し直す）"""
+        shm = self._shms.get(role)
+        if shm is None or shm.size < size:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = self._shms[role] = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        return shm
+
+    def extract(self, volume, slab_size=None, morphology="ndimage", threshold=THRESHOLD):
+        """ボリュームをz方向のスラブに分けてワーカーで処理し、マスクを返す"""
+        depth = volume.shape[0]
+        if slab_size is None:
+            # ワーカーあたり4スラブ程度に分けて負荷を均す
+            slab_size = max(1, -(-depth // (self.workers * 4)))
+        # ファイル全体を開いたメモリマップ（スライスしたビューはoffsetがずれるため除く）のみ直接参照する
+        if isinstance(volume, np.memmap) and isinstance(volume.base, mmap.mmap) and volume.flags.c_contiguous:
+            in_source = ("memmap", volume.filename, volume.offset)
+        else:
+            in_shm = self._buffer("input", volume.nbytes)
+            with PROFILER.stage("shared_copy"):
+                np.ndarray(volume.shape, dtype=volume.dtype, buffer=in_shm.buf)[...] = volume
+            in_source = ("shm", in_shm.name)
+        out_shm = self._buffer("output", int(np.prod(volume.shape)))
+        futures = [
+            self.executor.submit(
+                _process_slab,
+                in_source,
+                out_shm.name,
+                volume.shape,
+                volume.dtype,
+                z0,
+                min(z0 + slab_size, depth),
+                morphology,
+                threshold,
+            )
+            for z0 in range(0, depth, slab_size)
+        ]
+        for future in futures:
+            PROFILER.merge(future.result())
+        return np.ndarray(volume.shape, dtype=np.uint8, buffer=out_shm.buf).copy()
+
+    def close(self):
+        self.executor.shutdown()
+        for shm in self._shms.values():
+            shm.close()
+            shm.unlink()
+        self._shms = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def extract_trunk_parallel(volume, workers=None, slab_size=None, morphology="ndimage", threshold=THRESHOLD, pool=None):
+    """ボリュームをz方向のスラブに分け、プロセスプールで並列に体幹抽出する
+
+    入力がnp.memmapならワーカーが同じファイルを直接開き、それ以外は共有メモリに1回だけコピーする。
+    各スライスは独立に処理できるため、スラブの境界に重なり（halo）は不要。
+    pool（TrunkPool）を指定した場合はそのプロセスプールと共有メモリを再利用する。
+    """
+    if pool is not None:
+        return pool.extract(volume, slab_size, morphology, threshold)
+    with TrunkPool(workers) as pool:
+        return pool.extract(volume, slab_size, morphology, threshold)
+
+def _bbox(bin_img):
+    """最後の2軸（y, x）で前景を含む範囲(y0, y1, x0, x1)を返す（前景がなければNone）"""
+    rows = bin_img.any(axis=tuple(range(bin_img.ndim - 2)) + (bin_img.ndim - 1,))
+    cols = bin_img.any(axis=tuple(range(bin_img.ndim - 1)))
+    ys = np.flatnonzero(rows)
+    if len(ys) == 0:
+        return None
+    xs = np.flatnonzero(cols)
+    return ys[0], ys[-1] + 1, xs[0], xs[-1] + 1
+
+def threshold_roi(img, margin=ROI_MARGIN, threshold=THRESHOLD):
+    """閾値処理した前景の外接矩形にmarginを加えた処理範囲(y0, y1, x0, x1)を返す（前景がなければNone）
+
+    開閉処理・穴埋めは前景から余白の範囲内にしか影響しないため、範囲内だけの処理で結果は変わらない。
+    """
+    height, width = img.shape[-2:]
+    box = _bbox(auto_threshold(img, threshold))
+    if box is None:
+        return None
+    return (
+        max(box[0] - margin, 0),
+        min(box[1] + margin, height),
+        max(box[2] - margin, 0),
+        min(box[3] + margin, width),
+    )
+
+def downsample(volume, factor):
+    """y, x方向をfactor×factorのブロック平均で縮小する（割り切れない端は端の値で補う）"""
+    depth, height, width = volume.shape
+    pad = ((0, 0), (0, -height % factor), (0, -width % factor))
+    if any(p for _, p in pad):
+        volume = np.pad(volume, pad, mode="edge")
+    shape = (depth, volume.shape[1] // factor, factor, volume.shape[2] // factor, factor)
+    return volume.reshape(shape).mean(axis=(2, 4), dtype=np.float32)
+
+def upsample(mask, factor, shape):
+    """縮小したマスクを最近傍で拡大し、元の大きさshapeに切り揃える"""
+    mask = np.repeat(np.repeat(mask, factor, axis=1), factor, axis=2)
+    return mask[:, :shape[1], :shape[2]]
+
+def extract_trunk_pyramid(volume, factor=2, **options):
+    """1/factorに縮小した画像で体幹抽出を行い、拡大したマスクの境界付近だけ元の解像度で再判定する
+
+    境界から縮小率の画素数以内を境界帯とし、帯の中は元の解像度の閾値処理の結果で置き換える。
+    optionsはextract_trunkにそのまま渡す。
+    """
+    with PROFILER.stage("downsample"):
+        small = downsample(volume, factor)
+    coarse = extract_trunk(small, **options)
+    with PROFILER.stage("refine"):
+        mask = upsample(coarse, factor, volume.shape).astype(bool)
+        size = 2 * factor + 1
+        band = box_dilation(mask, size) & ~box_erosion(mask, size)
+        mask[band] = auto_threshold(volume[band], options.get("threshold", THRESHOLD)).astype(bool)
+        return mask.astype(np.uint8)
+
+def dice(a, b):
+    """2つのマスクのDice係数を返す（両方とも空なら1.0）"""
+    a = a.astype(bool)
+    b = b.astype(bool)
+    total = int(np.count_nonzero(a)) + int(np.count_nonzero(b))
+    return 2.0 * np.count_nonzero(a & b) / total if total else 1.0
+
+def pyramid_report(volume, factor, **options):
+    """元の解像度とfactor倍縮小の結果を比較し、(縮小版のマスク, 処理時間とDice係数の辞書)を返す"""
+    start = time.perf_counter()
+    full = extract_trunk(volume, **options)
+    full_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    coarse = extract_trunk(volume, pyramid=factor, **options)
+    coarse_seconds = time.perf_counter() - start
+    slice_dice = [dice(f, c) for f, c in zip(full, coarse)]
+    report = {
+        "factor": factor,
+        "dice": dice(full, coarse),
+        "slice_dice_min": min(slice_dice) if slice_dice else 1.0,
+        "slice_dice_mean": float(np.mean(slice_dice)) if slice_dice else 1.0,
+        "different_voxels": int(np.count_nonzero(full != coarse)),
+        "full_seconds": full_seconds,
+        "pyramid_seconds": coarse_seconds,
+    }
+    return coarse, report
+
+def extract_trunk(
+    volume, mode="slice", workers=None, morphology="ndimage", roi="none", pyramid=1, threshold=THRESHOLD, pool=None
+):
+    """各スライスごとに2Dラベリング最大領域のみ抽出
+
+    mode="volume"の場合はスライスごとのループを使わず、全スライスをまとめて処理する。
+    mode="parallel"の場合はスラブごとにworkers個のプロセスで並列に処理する。
+    morphologyは開閉処理の実装（"ndimage"または"separable"、結果は同じ）。
+    roi="slice"の場合はスライスごとに、roi="volume"の場合は全スライス共通に
+    閾値処理した前景の外接矩形＋余白だけを処理する（sliceモード以外では全スライス共通の範囲を使う）。
+    pyramidに2以上を指定すると、1/pyramidに縮小して処理し境界付近だけ元の解像度で再判定する（近似）。
+    thresholdは全スライス共通の閾値（auto_thresholdに渡す）。
+    poolはparallelモードで再利用するTrunkPool（省略時は呼び出しごとにプロセスプールを作る）。
+    """
+    if pyramid > 1:
+        return extract_trunk_pyramid(
+            volume, pyramid, mode=mode, workers=workers, morphology=morphology, roi=roi, threshold=threshold, pool=pool
+        )
     trunk_mask = np.zeros_like(volume, dtype=np.uint8)
+    if roi == "volume" or (roi == "slice" and mode != "slice"):
+        with PROFILER.stage("roi"):
+            box = threshold_roi(volume, threshold=threshold)
+        if box is not None:
+            y0, y1, x0, x1 = box
+            trunk_mask[:, y0:y1, x0:x1] = extract_trunk(
+                volume[:, y0:y1, x0:x1], mode, workers, morphology, threshold=threshold, pool=pool
+            )
+        return trunk_mask
+    if mode == "volume":
+        return process_volume(volume, morphology, threshold)
+    if mode == "parallel":
+        return extract_trunk_parallel(volume, workers, morphology=morphology, threshold=threshold, pool=pool)
     for z in range(volume.shape[0]):
-        trunk_mask[z] = process_slice(volume[z])
+        if roi != "slice":
+            trunk_mask[z] = process_slice(volume[z], morphology, threshold)
+            continue
+        with PROFILER.stage("roi"):
+            box = threshold_roi(volume[z], threshold=threshold)
+        if box is not None:
+            y0, y1, x0, x1 = box
+            trunk_mask[z, y0:y1, x0:x1] = process_slice(volume[z, y0:y1, x0:x1], morphology, threshold)
     return trunk_mask
 
+def extract_trunk_streaming(input_nifti, output_nifti, slab_size=32, **options):
+    """NIfTIをz方向のスラブごとに読み込んで体幹抽出し、マスク（体幹=255）を出力へ順に書き込む
+
+    メモリ使用量はボリューム全体ではなくスラブの大きさで決まる。
+    ビットに詰めたマスク（PackedMask、元の1/8の大きさ）を返す。optionsはextract_trunkにそのまま渡す。
+    parallelモードではプロセスプールと共有メモリを最初に1回だけ用意し、全スラブで再利用する。
+    """
+    packed = []
+    pool = TrunkPool(options.get("workers")) if options.get("mode") == "parallel" else None
+    try:
+        with NiftiSlabReader(input_nifti) as reader, NiftiMaskWriter(output_nifti, reader.header, reader.info) as writer:
+            slabs = reader.iter_slabs(slab_size)
+            while True:
+                with PROFILER.stage("read"):
+                    item = next(slabs, None)
+                if item is None:
+                    break
+                mask = extract_trunk(item[2], pool=pool, **options)
+                with PROFILER.stage("write"):
+                    packed.append(PackedMask.from_mask(mask))
+                    writer.write_slab(np.multiply(mask, 255, out=mask))
+    finally:
+        if pool is not None:
+            pool.close()
+    return PackedMask.concatenate(packed, image_geometry(input_nifti))
+
+def image_geometry(path):
+    """画像のヘッダーだけを読み込み、画素間隔・原点・方向の辞書を返す"""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return {"spacing": reader.GetSpacing(), "origin": reader.GetOrigin(), "direction": reader.GetDirection()}
+
+def parse_threshold(text):
+    """--thresholdの指定（数値または"auto"）を変換する"""
+    if text == "auto":
+        return text
+    try:
+        return float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"閾値は数値またはautoを指定してください: {text}")
+
+def array_histogram(volume, slab_size=32, bin_width=None, bins=DEFAULT_BINS):
+    """読み込み済みのボリュームのヒストグラムだけをz方向のスラブごとに求める（平均・分散は計算しない）"""
+    stats = StreamingStats(bin_width, bins, moments=False)
+    for z0 in range(0, volume.shape[0], slab_size):
+        stats.update(volume[z0:z0 + slab_size])
+    return stats
+
+def histogram_threshold(stats):
+    """全体のヒストグラムから大津の方法で閾値を求めて表示する
+
+    画素を含むビンがMIN_OCCUPIED_BINS個未満の場合は警告し、1個以下の場合や閾値より大きい画素がない場合は
+    既定値を使う（空のマスクを保存しないように）。
+    """
+    occupied = int(np.count_nonzero(stats.counts))
+    if occupied < 2:
+        print(f"警告: 画素値が1種類しかないため自動閾値を求められません。既定値{THRESHOLD}を使用します。", file=sys.stderr)
+        return THRESHOLD
+    if occupied < MIN_OCCUPIED_BINS:
+        print(f"警告: ヒストグラムの値が{occupied}種類しかないため、自動閾値が不安定な可能性があります。", file=sys.stderr)
+    threshold = stats.otsu_threshold()
+    if not stats.counts[stats.values() > threshold].any():
+        print(
+            f"警告: 自動閾値{threshold:g}より大きい画素がありません。既定値{THRESHOLD}を使用します。",
+            file=sys.stderr,
+        )
+        return THRESHOLD
+    print(f"自動閾値（大津の方法）: {threshold:g}")
+    return threshold
+
+def warn_empty(count, threshold):
+    """体幹領域が見つからなかった場合に警告する"""
+    if count == 0:
+        print(f"警告: 体幹領域が見つかりませんでした（閾値 {threshold:g}）。--thresholdを確認してください。", file=sys.stderr)
+
 def main():
     parser = argparse.ArgumentParser(description="CT/MR画像から体幹領域抽出（NIfTI形式）")
     parser.add_argument("input_nifti", help="入力NIfTIファイル（CT/MR画像）")
     parser.add_argument("output_nifti", help="出力NIfTIファイル（体幹マスク）")
+    parser.add_argument(
+        "--mode",
+        choices=["slice", "volume", "parallel"],
+        default="slice",
+        help="slice: スライスごとに処理, volume: 全スライスをまとめて3次元処理, parallel: スラブごとに複数プロセスで処理（結果は同じ）",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="parallelモードのプロセス数（省略時はCPU数）")
+    parser.add_argument(
+        "--morphology",
+        choices=["ndimage", "separable"],
+        default="ndimage",
+        help="開閉処理の実装（ndimage: scipy.ndimage, separable: 行・列方向の累積和に分解、結果は同じ）",
+    )
+    parser.add_argument(
+        "--roi",
+        choices=["none", "slice", "volume"],
+        default="none",
+        help="閾値処理した前景の外接矩形＋余白だけを処理（slice: スライスごと, volume: 全スライス共通、結果は同じ）",
+    )
+    parser.add_argument(
+        "--pyramid",
+        type=int,
+        default=1,
+        help="縦横1/Nに縮小して処理し、境界付近だけ元の解像度で再判定する（1: 縮小しない、近似）",
+    )
+    parser.add_argument(
+        "--pyramid-report",
+        default=None,
+        help="元の解像度の結果とのDice係数・処理時間をJSONで保存するファイル名（元の解像度でも処理する）",
+    )
+    parser.add_argument(
+        "--slab",
+        type=int,
+        default=None,
+        help="指定した枚数ずつNIfTIを読み込み・処理・書き込みする（NIfTI-1の.nii/.nii.gzのみ、メモリ使用量を抑える）",
+    )
+    parser.add_argument(
+        "--packed",
+        default=None,
+        help="マスクを1画素1ビットに詰めたnpzファイル（スライスごとの画素数・ラン数付き）としても保存するファイル名",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=parse_threshold,
+        default=THRESHOLD,
+        help=f"閾値処理の閾値（デフォルト: {THRESHOLD}）。autoの場合は全体のヒストグラムから大津の方法で求める（MR画像向け）",
+    )
+    parser.add_argument(
+        "--histogram",
+        default=None,
+        help="--threshold autoで使う、test.py --save-histogramで保存したヒストグラム（npz）。指定すると画像の走査を省略する",
+    )
+    parser.add_argument(
+        "--bins",
+        type=int,
+        default=DEFAULT_BINS,
+        help="--threshold autoのヒストグラムのビンの数（浮動小数点型の画像でビンの幅を決める際に使用）",
+    )
+    parser.add_argument(
+        "--bin-width",
+        type=float,
+        default=None,
+        help="--threshold autoのヒストグラムのビンの幅（省略時は整数型の画像は1、浮動小数点型は--binsから決める）",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="処理段階ごとの累積時間・呼び出し回数・確保メモリの最大値をJSONで保存するファイル名",
+    )
     args = parser.parse_args()
+    if args.pyramid < 1:
+        parser.error("--pyramidは1以上を指定してください。")
+    if args.slab is not None and args.pyramid_report:
+        parser.error("--slabと--pyramid-reportは同時に指定できません。")
+    if args.bins < 2 or (args.bin_width is not None and args.bin_width <= 0):
+        parser.error("--binsは2以上、--bin-widthは正の値を指定してください。")
+    if args.histogram and args.threshold != "auto":
+        parser.error("--histogramは--threshold autoと併用してください。")
+
+    options = {"mode": args.mode, "workers": args.workers, "morphology": args.morphology, "roi": args.roi}
+    if args.profile:
+        PROFILER.start()
+    start = time.perf_counter()
+    stats = StreamingStats.load(args.histogram) if args.histogram else None
+    if args.slab is not None:
+        if args.threshold == "auto":
+            if stats is None:
+                # スラブの処理前に閾値が必要なため、ヒストグラムだけを先に1回走査して求める
+                with PROFILER.stage("histogram"):
+                    stats = volume_stats(args.input_nifti, args.slab, args.bin_width, args.bins, moments=False)
+            options["threshold"] = histogram_threshold(stats)
+        else:
+            options["threshold"] = args.threshold
+        # スラブごとに読み込み・体幹抽出・書き込み（ボリューム全体を読み込まない）
+        packed = extract_trunk_streaming(args.input_nifti, args.output_nifti, args.slab, pyramid=args.pyramid, **options)
+        print(f"体幹領域画素数: {packed.count()}")
+        warn_empty(packed.count(), options["threshold"])
+        print(f"Saved: {args.output_nifti}")
+        if args.packed:
+            packed.save(args.packed)
+            print(f"Saved: {args.packed}")
+        slice_voxels = packed.counts
+    else:
+        # NIfTI画像読み込み
+        with PROFILER.stage("read"):
+            img = sitk.ReadImage(args.input_nifti)
+            arr = sitk.GetArrayFromImage(img)  # shape: (z, y, x)
+
+        # 閾値（autoの場合は読み込んだ画像のヒストグラムから求める。ファイルの再読み込みはしない）
+        if args.threshold == "auto":
+            if stats is None:
+                with PROFILER.stage("histogram"):
+                    stats = array_histogram(arr, bin_width=args.bin_width, bins=args.bins)
+            options["threshold"] = histogram_threshold(stats)
+        else:
+            options["threshold"] = args.threshold
 
-    # NIfTI画像読み込み
-    img = sitk.ReadImage(args.input_nifti)
-    arr = sitk.GetArrayFromImage(img)  # shape: (z, y, x)
+        # 体幹抽出（各断面で最大領域のみ白）
+        if args.pyramid_report:
+            trunk_mask, report = pyramid_report(arr, args.pyramid, **options)
+            print(
+                f"Dice係数: {report['dice']:.4f}（スライス最小 {report['slice_dice_min']:.4f}）, "
+                f"処理時間: {report['pyramid_seconds']:.2f}秒（元の解像度 {report['full_seconds']:.2f}秒）"
+            )
+            with open(args.pyramid_report, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        else:
+            trunk_mask = extract_trunk(arr, pyramid=args.pyramid, **options)
+        print(f"体幹領域画素数: {np.sum(trunk_mask)}")
+        warn_empty(np.sum(trunk_mask), options["threshold"])
 
-    # 体幹抽出（各断面で最大領域のみ白）
-    trunk_mask = extract_trunk(arr)
-    print(f"体幹領域画素数: {np.sum(trunk_mask)}")
+        # NIfTI画像として保存（np.uint8, 体幹=255, その他=0）
+        with PROFILER.stage("write"):
+            mask_img = sitk.GetImageFromArray((trunk_mask * 255).astype(np.uint8))
+            mask_img.CopyInformation(img)
+            sitk.WriteImage(mask_img, args.output_nifti)
+        print(f"Saved: {args.output_nifti}")
+        if args.packed:
+            geometry = {"spacing": img.GetSpacing(), "origin": img.GetOrigin(), "direction": img.GetDirection()}
+            PackedMask.from_mask(trunk_mask, geometry).save(args.packed)
+            print(f"Saved: {args.packed}")
+        slice_voxels = trunk_mask.reshape(trunk_mask.shape[0], -1).sum(axis=1)
 
-    # NIfTI画像として保存（np.uint8, 体幹=255, その他=0）
-    mask_img = sitk.GetImageFromArray((trunk_mask * 255).astype(np.uint8))
-    mask_img.CopyInformation(img)
-    sitk.WriteImage(mask_img, args.output_nifti)
-    print(f"Saved: {args.output_nifti}")
+    if args.profile:
+        # 段階ごとの時間・呼び出し回数・メモリと、スライスごとの体幹領域画素数を保存
+        report = PROFILER.report(
+            wall_seconds=time.perf_counter() - start,
+            options=dict(options, pyramid=args.pyramid, slab=args.slab),
+            slice_voxels=[int(v) for v in slice_voxels],
+        )
+        PROFILER.stop()
+        with open(args.profile, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        for name, record in report["stages"].items():
+            print(f"{name:>12}: {record['seconds']:8.3f}秒 {record['calls']:6d}回 最大{record['peak_bytes'] / 1e6:9.1f}MB")
+        print(f"Saved: {args.profile}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,44 @@
+import numpy as np
+
+def _window_sums(img, size, axis):
+    """axis方向に幅sizeの窓内の画素数を累積和の差で求める（画像外は0として扱う）"""
+    r = size // 2
+    n = img.shape[axis]
+    pad = [(0, 0)] * img.ndim
+    pad[axis] = (r + 1, r)
+    # 窓内の和はsize以下なので、累積和が収まる最小の型を使う
+    dtype = np.uint16 if n + size < np.iinfo(np.uint16).max else np.uint32
+    cumsum = np.cumsum(np.pad(img.astype(np.uint8, copy=False), pad), axis=axis, dtype=dtype)
+    upper = [slice(None)] * img.ndim
+    lower = [slice(None)] * img.ndim
+    upper[axis] = slice(size, size + n)
+    lower[axis] = slice(0, n)
+    return cumsum[tuple(upper)] - cumsum[tuple(lower)]
+
+def box_erosion(img, size, axes=(-2, -1)):
+    """size×sizeの正方形による収縮を、各軸の1次元の収縮に分解して行う"""
+    out = np.asarray(img, dtype=bool)
+    for axis in axes:
+        out = _window_sums(out, size, axis) == size
+    return out
+
+def box_dilation(img, size, axes=(-2, -1)):
+    """size×sizeの正方形による膨張を、各軸の1次元の膨張に分解して行う"""
+    out = np.asarray(img, dtype=bool)
+    for axis in axes:
+        out = _window_sums(out, size, axis) > 0
+    return out
+
+def effective_size(size, iterations):
+    """正方形の構造要素をiterations回適用した場合と等価な正方形の一辺を返す（5×5を2回なら9×9）"""
+    return iterations * (size - 1) + 1
+
+def box_opening(img, size, iterations=1, axes=(-2, -1)):
+    """ndimage.binary_opening(structure=size×sizeの1, iterations)と同じ結果のオープニング"""
+    size = effective_size(size, iterations)
+    return box_dilation(box_erosion(img, size, axes), size, axes)
+
+def box_closing(img, size, iterations=1, axes=(-2, -1)):
+    """ndimage.binary_closing(structure=size×sizeの1, iterations)と同じ結果のクロージング"""
+    size = effective_size(size, iterations)
+    return box_erosion(box_dilation(img, size, axes), size, axes)
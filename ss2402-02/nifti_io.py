@@ -0,0 +1,165 @@
+import gzip
+import struct
+import numpy as np
+
+# NIfTI-1ヘッダーの大きさと、データの開始位置（ヘッダー＋拡張フラグ4バイト）
+NIFTI_HEADER_SIZE = 348
+NIFTI_DATA_OFFSET = 352
+
+# NIfTIのdatatypeコードとnumpyの型の対応
+NIFTI_DTYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64,
+}
+
+def _open(path, mode="rb"):
+    """拡張子が.gzならgzipとして開く"""
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+def read_nifti_header(path):
+    """NIfTI-1ヘッダーを読み込み、(ヘッダーのバイト列, 項目の辞書)を返す
+
+    辞書のshapeは(z, y, x)順。
+    """
+    with _open(path) as f:
+        header = f.read(NIFTI_HEADER_SIZE)
+    if len(header) < NIFTI_HEADER_SIZE:
+        raise ValueError(f"{path}はNIfTIファイルではありません。")
+    if struct.unpack("<i", header[:4])[0] == NIFTI_HEADER_SIZE:
+        endian = "<"
+    elif struct.unpack(">i", header[:4])[0] == NIFTI_HEADER_SIZE:
+        endian = ">"
+    else:
+        raise ValueError(f"{path}はNIfTI-1形式ではありません（スラブ読み込みはNIfTI-1のみ対応）。")
+    dim = struct.unpack(endian + "8h", header[40:56])
+    datatype = struct.unpack(endian + "h", header[70:72])[0]
+    if datatype not in NIFTI_DTYPES:
+        raise ValueError(f"未対応のNIfTIデータ型です: {datatype}")
+    if dim[0] < 3 or any(d > 1 for d in dim[4:dim[0] + 1]):
+        raise ValueError("3次元のNIfTI画像のみ対応しています。")
+    slope, inter = struct.unpack(endian + "2f", header[112:120])
+    info = {
+        "endian": endian,
+        "shape": (dim[3], dim[2], dim[1]),
+        "dtype": np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(endian),
+        "vox_offset": int(struct.unpack(endian + "f", header[108:112])[0]),
+        "slope": slope,
+        "inter": inter,
+    }
+    return header, info
+
+class NiftiSlabReader:
+    """NIfTI-1画像をz方向のスラブ単位で読み込むクラス
+
+    非圧縮（.nii）はnp.memmapで必要なスライスだけを参照し、
+    gzip圧縮（.nii.gz）は先頭から順に展開しながら前後のhalo枚だけを保持する。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header, self.info = read_nifti_header(path)
+        self.shape = self.info["shape"]
+        self._memmap = None
+        if not path.endswith(".gz"):
+            self._memmap = np.memmap(
+                path, dtype=self.info["dtype"], mode="r", offset=self.info["vox_offset"], shape=self.shape
+            )
+
+    def _scale(self, data):
+        """scl_slope・scl_interが指定されていれば実数値に変換する（SimpleITKの読み込みと同じ）"""
+        slope, inter = self.info["slope"], self.info["inter"]
+        if slope != 0.0 and (slope != 1.0 or inter != 0.0):
+            return data.astype(np.float32) * np.float32(slope) + np.float32(inter)
+        return np.asarray(data, dtype=self.info["dtype"].newbyteorder("="))
+
+    def iter_slabs(self, slab_size, halo=0):
+        """(開始z, 終了z, 前後にhalo枚を加えたスラブ)を順に返す"""
+        depth = self.shape[0]
+        if self._memmap is not None:
+            for z0 in range(0, depth, slab_size):
+                z1 = min(z0 + slab_size, depth)
+                yield z0, z1, self._scale(self._memmap[max(z0 - halo, 0):min(z1 + halo, depth)])
+            return
+        slice_bytes = int(np.prod(self.shape[1:])) * self.info["dtype"].itemsize
+        buffered = []
+        start = 0
+        with gzip.open(self.path, "rb") as f:
+            f.seek(self.info["vox_offset"])
+            for z0 in range(0, depth, slab_size):
+                z1 = min(z0 + slab_size, depth)
+                lo, hi = max(z0 - halo, 0), min(z1 + halo, depth)
+                del buffered[:lo - start]
+                start = lo
+                while start + len(buffered) < hi:
+                    data = f.read(slice_bytes)
+                    if len(data) < slice_bytes:
+                        raise ValueError(f"{self.path}のデータが途中で終わっています。")
+                    buffered.append(np.frombuffer(data, dtype=self.info["dtype"]).reshape(self.shape[1:]))
+                yield z0, z1, self._scale(np.stack(buffered))
+
+    def close(self):
+        self._memmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class NiftiMaskWriter:
+    """入力のNIfTI-1ヘッダー（向き・画素間隔など）を引き継ぎ、uint8のマスクをスライス順に追記するクラス
+
+    出力ファイル名が.gzで終わる場合はgzip圧縮しながら書き込む。
+    """
+
+    def __init__(self, path, header, info):
+        self.path = path
+        self.shape = info["shape"]
+        self.count = 0
+        endian = info["endian"]
+        header = bytearray(header)
+        dim = list(struct.unpack(endian + "8h", header[40:56]))
+        dim[0] = 3
+        dim[4:] = [1] * 4
+        header[40:56] = struct.pack(endian + "8h", *dim)
+        header[70:74] = struct.pack(endian + "2h", 2, 8)  # datatype=uint8, bitpix=8
+        header[108:120] = struct.pack(endian + "3f", NIFTI_DATA_OFFSET, 0.0, 0.0)  # vox_offset, scl_slope, scl_inter
+        header[124:132] = struct.pack(endian + "2f", 255.0, 0.0)  # cal_max, cal_min
+        self._file = _open(path, "wb")
+        self._file.write(bytes(header))
+        self._file.write(b"\0\0\0\0")
+
+    def write_slab(self, mask):
+        """続きのスライス群（z, y, x）を書き込む"""
+        mask = np.ascontiguousarray(mask, dtype=np.uint8)
+        if mask.shape[1:] != self.shape[1:] or self.count + mask.shape[0] > self.shape[0]:
+            raise ValueError("書き込むスライスの大きさまたは枚数が入力画像と一致しません。")
+        self._file.write(mask.tobytes())
+        self.count += mask.shape[0]
+
+    def close(self):
+        """ファイルを閉じる（書き込んだ枚数が足りない場合は例外）"""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if self.count != self.shape[0]:
+            raise ValueError(f"{self.path}に書き込んだスライス数（{self.count}）が画像の枚数（{self.shape[0]}）と一致しません。")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
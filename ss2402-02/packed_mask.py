@@ -0,0 +1,101 @@
+import numpy as np
+
+# 1バイト（0〜255）に含まれる1のビット数
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def popcount(packed, axis=None):
+    """パック済み配列の1のビット数を数える（展開せずに変換テーブルで数える）"""
+    return POPCOUNT[packed].sum(axis=axis, dtype=np.int64)
+
+def run_starts(packed):
+    """各バイトのうち、x方向の連続領域（ラン）の始まりになっているビットだけを残す
+
+    packbitsはバイトの上位ビットから順に詰めるため、左隣の画素は1つ上位のビット
+    （バイトの先頭では前のバイトの最下位ビット）になる。
+    """
+    left = packed >> 1
+    left[..., 1:] |= (packed[..., :-1] & 1) << 7
+    return packed & ~left
+
+class PackedMask:
+    """(z, y, x)の2値マスクをx方向にnp.packbitsで1画素1ビットに詰めて保持するクラス
+
+    スライスごとの画素数・ラン数・外接矩形を保持し、和・積・画素数の計算は展開せずに行う。
+    """
+
+    def __init__(self, data, shape, geometry=None, counts=None, runs=None):
+        self.data = data
+        self.shape = tuple(int(v) for v in shape)
+        self.geometry = geometry or {}
+        self.counts = popcount(data, axis=(1, 2)) if counts is None else np.asarray(counts, dtype=np.int64)
+        self.runs = popcount(run_starts(data), axis=(1, 2)) if runs is None else np.asarray(runs, dtype=np.int64)
+
+    @classmethod
+    def from_mask(cls, mask, geometry=None):
+        """0/1（または0/255）のマスク配列から作成する"""
+        return cls(np.packbits(mask.astype(bool), axis=-1), mask.shape, geometry)
+
+    @classmethod
+    def concatenate(cls, masks, geometry=None):
+        """z方向に並んだ複数のPackedMask（スラブごとの結果など）をつなげる"""
+        data = np.concatenate([m.data for m in masks], axis=0)
+        shape = (sum(m.shape[0] for m in masks),) + masks[0].shape[1:]
+        counts = np.concatenate([m.counts for m in masks])
+        runs = np.concatenate([m.runs for m in masks])
+        return cls(data, shape, geometry or masks[0].geometry, counts, runs)
+
+    def unpack(self):
+        """uint8（0/1）のマスク配列に展開する"""
+        return np.unpackbits(self.data, axis=-1, count=self.shape[2])
+
+    def count(self):
+        """マスク全体の画素数を返す"""
+        return int(self.counts.sum())
+
+    def bbox(self):
+        """スライスごとの外接矩形(y0, y1, x0, x1)を(z, 4)の配列で返す（空のスライスは全て0）"""
+        boxes = np.zeros((self.shape[0], 4), dtype=np.int64)
+        rows = self.data.any(axis=2)
+        cols = np.bitwise_or.reduce(self.data, axis=1)
+        for z in np.flatnonzero(self.counts):
+            ys = np.flatnonzero(rows[z])
+            xs = np.flatnonzero(np.unpackbits(cols[z], count=self.shape[2]))
+            boxes[z] = ys[0], ys[-1] + 1, xs[0], xs[-1] + 1
+        return boxes
+
+    def _check(self, other):
+        if self.shape != other.shape:
+            raise ValueError(f"マスクの大きさが一致しません: {self.shape}と{other.shape}")
+
+    def __or__(self, other):
+        """和集合"""
+        self._check(other)
+        return PackedMask(self.data | other.data, self.shape, self.geometry)
+
+    def __and__(self, other):
+        """積集合"""
+        self._check(other)
+        return PackedMask(self.data & other.data, self.shape, self.geometry)
+
+    def intersection_count(self, other):
+        """積集合の画素数を、新しいマスクを保持せずに返す"""
+        self._check(other)
+        return int(popcount(self.data & other.data))
+
+    def save(self, path):
+        """npz形式（パック済みデータ・大きさ・スライスごとの画素数とラン数・画像の位置情報）で保存する"""
+        np.savez_compressed(
+            path,
+            data=self.data,
+            shape=np.array(self.shape, dtype=np.int64),
+            counts=self.counts,
+            runs=self.runs,
+            **{f"geometry_{k}": np.asarray(v, dtype=np.float64) for k, v in self.geometry.items()},
+        )
+
+    @classmethod
+    def load(cls, path):
+        """saveで保存したnpzファイルを読み込む"""
+        with np.load(path) as f:
+            geometry = {k[len("geometry_"):]: tuple(f[k].tolist()) for k in f.files if k.startswith("geometry_")}
+            return cls(f["data"], f["shape"], geometry, f["counts"], f["runs"])
@@ -0,0 +1,71 @@
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class StageProfiler:
+    """処理段階ごとの累積時間・呼び出し回数・確保メモリの最大値を記録するクラス
+
+    無効の間はstageが何もしないため、計測しない通常の実行にはほとんど影響しない。
+    メモリはtracemallocで計測する（numpyの配列の確保も含まれる）。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+
+    def start(self):
+        """計測を開始する"""
+        self.enabled = True
+        self.stages = {}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        """計測を終了する"""
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        """withブロックの処理時間と、ブロック内で増えたメモリの最大値を記録する"""
+        if not self.enabled:
+            yield
+            return
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] - current
+            record = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "peak_bytes": 0})
+            record["seconds"] += seconds
+            record["calls"] += 1
+            record["peak_bytes"] = max(record["peak_bytes"], peak)
+
+    def merge(self, stages):
+        """別プロセスで記録した段階ごとの結果を加える"""
+        for name, other in stages.items():
+            record = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "peak_bytes": 0})
+            record["seconds"] += other["seconds"]
+            record["calls"] += other["calls"]
+            record["peak_bytes"] = max(record["peak_bytes"], other["peak_bytes"])
+
+    def take(self):
+        """記録した結果を返して空にする（ワーカープロセスから結果を返す際に使用）"""
+        stages, self.stages = self.stages, {}
+        return stages
+
+    def report(self, **extra):
+        """段階ごとの結果を時間の長い順に並べた辞書を返す"""
+        total = sum(r["seconds"] for r in self.stages.values())
+        stages = {
+            name: dict(record, share=record["seconds"] / total if total else 0.0)
+            for name, record in sorted(self.stages.items(), key=lambda item: -item[1]["seconds"])
+        }
+        return dict(extra, stage_seconds=total, stages=stages)
+
+# パイプライン全体で共有する計測器（--profile指定時のみ有効）
+PROFILER = StageProfiler()
@@ -1,30 +1,49 @@
 import argparse
-import SimpleITK as sitk
-import numpy as np
 import matplotlib.pyplot as plt
 
+from histogram import DEFAULT_BINS, volume_stats
+
 def main():
     parser = argparse.ArgumentParser(description="NIfTI画像の画素値ヒストグラム表示")
     parser.add_argument("input_nifti", help="入力NIfTIファイル（CT/MR画像）")
+    parser.add_argument("--slab", type=int, default=32, help="一度に読み込むスライス数")
+    parser.add_argument(
+        "--bin-width",
+        type=float,
+        default=None,
+        help="ヒストグラムのビンの幅（省略時は整数型の画像は1で正確な中央値・パーセンタイル、浮動小数点型は--binsから決める）",
+    )
+    parser.add_argument("--bins", type=int, default=DEFAULT_BINS, help="浮動小数点型の画像でビンの幅を決める際のビンの数")
+    parser.add_argument("--save-histogram", default=None, help="ヒストグラム・統計量をnpzで保存するファイル名")
+    parser.add_argument("--no-plot", action="store_true", help="ヒストグラムを表示しない")
     args = parser.parse_args()
 
-    # NIfTI画像読み込み
-    img = sitk.ReadImage(args.input_nifti)
-    arr = sitk.GetArrayFromImage(img)  # shape: (z, y, x)
+    # NIfTI画像をスラブごとに1回だけ読み込み、ヒストグラム・平均・標準偏差を求める
+    stats = volume_stats(args.input_nifti, args.slab, args.bin_width, args.bins)
 
-    # ヒストグラム表示
-    plt.figure(figsize=(8, 5))
-    plt.hist(arr.flatten(), bins=100, color='blue', alpha=0.7)
-    plt.xlabel("Pixel Value")
-    plt.ylabel("Frequency")
-    plt.title("Histogram of NIfTI Image")
-    plt.grid(True)
-    plt.show()
+    # ヒストグラム表示（求めたヒストグラムを重みとして100個のビンにまとめる）
+    if not args.no_plot:
+        plt.figure(figsize=(8, 5))
+        plt.hist(stats.values(), bins=100, weights=stats.counts, color='blue', alpha=0.7)
+        plt.xlabel("Pixel Value")
+        plt.ylabel("Frequency")
+        plt.title("Histogram of NIfTI Image")
+        plt.grid(True)
+        plt.show()
 
     # 画素値の統計情報表示
-    print(f"Mean: {np.mean(arr):.2f}")
-    print(f"Median: {np.median(arr):.2f}")
-    print(f"Std Dev: {np.std(arr):.2f}")
+    print(f"Mean: {stats.mean:.2f}")
+    print(f"Median: {stats.median():.2f}")
+    print(f"Std Dev: {stats.std():.2f}")
+    p1, p99 = stats.percentile([1, 99])
+    print(f"Min: {stats.minimum():.2f}, Max: {stats.maximum():.2f}, 1%: {p1:.2f}, 99%: {p99:.2f}")
+    if stats.nonfinite:
+        print(f"※NaN・無限大の画素（{stats.nonfinite}個）は除いて集計しました。")
+    if not stats.exact:
+        print(f"※中央値・パーセンタイルは幅{stats.bin_width:g}のビンの中央で近似した値です。")
+    if args.save_histogram:
+        stats.save(args.save_histogram)
+        print(f"Saved: {args.save_histogram}")
 
 if __name__ == "__main__":
     main()